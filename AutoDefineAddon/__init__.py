@@ -1 +1,7 @@
-from . import autodefine
\ No newline at end of file
+import importlib
+import time
+
+# imported through importlib, so the time it takes can be measured without an import statement after code
+_started = time.perf_counter()
+autodefine = importlib.import_module(".autodefine", __name__)
+autodefine.startup_seconds = time.perf_counter() - _started
@@ -0,0 +1,65 @@
+# Local store of downloaded pronunciation files, shared by every profile and collection on this computer.
+#
+# Merriam-Webster names each recording uniquely (e.g. "set00001.wav"), so the file name is used as the key. Reading a
+# file bumps its modification time, and once the store grows past its size cap the least recently used files are
+# deleted first.
+
+import os
+import threading
+
+
+class AudioStore:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    def _path(self, filename):
+        # file names come from the API response, so make sure they can't point outside the store
+        return os.path.join(self.directory, os.path.basename(filename))
+
+    def get(self, filename):
+        path = self._path(filename)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, filename, data):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(filename)
+            temp_path = path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temp_path, path)
+            if self._total_bytes is None:
+                self._total_bytes = self._size_on_disk()
+            else:
+                self._total_bytes += len(data) - old_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _files(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp")]
+
+    def _size_on_disk(self):
+        return sum(entry.stat().st_size for entry in self._files())
+
+    def _evict(self):
+        for entry in sorted(self._files(), key=lambda entry: entry.stat().st_mtime):
+            if self._total_bytes <= self.max_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._total_bytes -= size
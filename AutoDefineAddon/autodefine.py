@@ -5,23 +5,34 @@
 # https://github.com/z1lc/AutoDefine                      Licensed under GPL v2
 
 import os
-from collections import namedtuple
 
 import platform
 import re
+import threading
+import time
 import traceback
-import urllib.error
-import urllib.parse
-import urllib.request
 from anki import version
 from anki.hooks import addHook
+from anki.notes import Note
 from aqt import mw
-from aqt.utils import showInfo, tooltip
-from http.client import RemoteDisconnected
-from urllib.error import URLError
-from xml.etree import ElementTree as ET
-
-from .libs import webbrowser
+from aqt.qt import QAction, QCursor, QDialog, QFileDialog, QHBoxLayout, QMenu, QPlainTextEdit, QPushButton, QVBoxLayout
+from aqt.utils import askUser, showInfo, tooltip
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from itertools import takewhile
+
+# Only what's needed to add the buttons and menu entries is imported while Anki starts up. The modules doing the actual
+# work (and the HTTP, XML and SQLite libraries behind them) are imported by the functions using them, on first use.
+from . import instrumentation
+from .audio import AudioStore
+from .collection_index import CollectionIndex
+from .instrumentation import Invocation, InvocationLog
+from .lemmas import InflectionIndex
+from .quota import ApiQuota, QuotaExceeded
+from .render import render_definitions, render_phonetic_transcriptions, sound_urls
+from .singleflight import SingleFlight
+from .sources import Source, SourceRegistry
+from .spelling import SpellingIndex
 
 # --------------------------------- SETTINGS ---------------------------------
 
@@ -60,8 +71,74 @@ PRONOUNCE_ONLY_SHORTCUT = ""
 
 PHONETIC_TRANSCRIPTION_ONLY_SHORTCUT = ""
 
+# How many days to keep API responses in the on-disk lookup cache (use 0 to turn off)
+CACHE_TTL_DAYS = 30
+
+# Maximum number of API responses kept in the on-disk lookup cache; least recently used ones are evicted first
+CACHE_MAX_ENTRIES = 10000
+
+# How many days to remember that a dictionary has no entry for a word, with its suggestions (use 0 to turn off)
+NEGATIVE_CACHE_TTL_DAYS = 3
+
+# How to query the two dictionaries. Available options are LAZY (only ask the other dictionary if the preferred one has
+# no entry) and RACE (ask both at once and take the preferred result; faster, but always uses two API calls).
+FETCH_MODE = "LAZY"
+
+# Which of Merriam-Webster's APIs to use. Available options are XML (the original v1 collegiate and v2 medical APIs) and
+# JSON (the v3 APIs).
+API_BACKEND = "XML"
+
+# How many seconds to wait for dictionaryapi.com before giving up on a lookup
+REQUEST_TIMEOUT_SECONDS = 10
+
+# How many words to look up at the same time when defining notes selected in the Browser
+BULK_WORKERS = 4
+
+# How many API calls each of your keys may make per day (Merriam-Webster's free keys allow 1000)
+DAILY_API_LIMIT = 1000
+
+# How many API calls per second AutoDefine may make with each key (use 0 for no limit)
+MAX_REQUESTS_PER_SECOND = 5
+
+# How many megabytes of pronunciation recordings to keep on this computer for reuse across notes and profiles
+AUDIO_CACHE_MB = 200
+
+# Look up each word of a selection of several words separately (all at the same time), instead of the selection as a
+# whole?
+SPLIT_SELECTION = False
+
+# Look the word up in the background while it's being typed into the first field, so pressing AutoDefine is instant?
+PREFETCH_WHILE_TYPING = False
+
 PART_OF_SPEECH_ABBREVIATION = {"verb": "v.", "noun": "n.", "adverb": "adv.", "adjective": "adj."}
 
+# How long the first field has to stay unchanged before it's prefetched, in milliseconds
+PREFETCH_DELAY_MS = 700
+
+# Share of the daily API limit that prefetching leaves untouched, so explicit lookups always have some budget
+PREFETCH_QUOTA_RESERVE = 0.1
+
+# How many recent invocations Tools > AutoDefine Timings keeps
+TIMINGS_TO_KEEP = 500
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:62.0) Gecko/20100101 Firefox/62.0"
+
+# Notes created from a word list are added and checkpointed this many at a time
+IMPORT_BATCH_SIZE = 50
+
+# Anki keeps this folder when the add-on is updated
+USER_FILES_DIR = os.path.join(os.path.dirname(__file__), "user_files")
+
+# Drop a pack built on another machine here (or build one from Tools > Build AutoDefine Offline Pack) to look words
+# up without internet access.
+OFFLINE_PACK_PATH = os.path.join(USER_FILES_DIR, "offline_pack.bin")
+
+# Recorded API responses to include when building an offline pack, laid out as <DICTIONARY>/<word>.xml
+RECORDED_RESPONSES_DIR = os.path.join(USER_FILES_DIR, "recorded")
+
+# How far each imported word list got, so an import stopped by the daily API limit can be resumed
+IMPORT_CHECKPOINT_PATH = os.path.join(USER_FILES_DIR, "import_checkpoints.json")
+
 
 # Collegiate Dictionary API XML documentation: http://goo.gl/LuD83A
 # Medical Dictionary API XML documentation: https://goo.gl/akvkbB
@@ -112,11 +189,22 @@ def get_definition_force_phonetic_transcription(editor):
 
 
 def validate_settings():
+    load_config()
     # ideally, we wouldn't have to force people to individually register, but the API limit is just 1000 calls/day.
 
-    if PREFERRED_DICTIONARY != "COLLEGIATE" and PREFERRED_DICTIONARY != "MEDICAL":
-        message = "Setting PREFERRED_DICTIONARY must be set to either COLLEGIATE or MEDICAL. Current setting: '%s'" \
-                  % PREFERRED_DICTIONARY
+    if _source_registry.get(PREFERRED_DICTIONARY) is None:
+        message = "Setting PREFERRED_DICTIONARY must be set to one of %s. Current setting: '%s'" \
+                  % (", ".join(source.name for source in _source_registry.ordered()), PREFERRED_DICTIONARY)
+        showInfo(message)
+        return
+
+    if FETCH_MODE != "LAZY" and FETCH_MODE != "RACE":
+        message = "Setting FETCH_MODE must be set to either LAZY or RACE. Current setting: '%s'" % FETCH_MODE
+        showInfo(message)
+        return
+
+    if API_BACKEND != "XML" and API_BACKEND != "JSON":
+        message = "Setting API_BACKEND must be set to either XML or JSON. Current setting: '%s'" % API_BACKEND
         showInfo(message)
         return
 
@@ -124,7 +212,7 @@ def validate_settings():
         message = "The preferred dictionary was set to MEDICAL, but no API key was provided.\n" \
                   "Please register for one at www.dictionaryapi.com."
         showInfo(message)
-        webbrowser.open("https://www.dictionaryapi.com/", 0, False)
+        _open_in_browser("https://www.dictionaryapi.com/", 0, False)
         return
 
     if MERRIAM_WEBSTER_API_KEY == "YOUR_KEY_HERE":
@@ -135,98 +223,368 @@ def validate_settings():
                   "2. In Anki, go to Tools > Add-Ons. Select AutoDefine, click \"Config\" on the right-hand side " \
                   "and replace YOUR_KEY_HERE with your unique API key.\n"
         showInfo(message)
-        webbrowser.open("https://www.dictionaryapi.com/", 0, False)
+        _open_in_browser("https://www.dictionaryapi.com/", 0, False)
         return
 
 
-ValidAndPotentialEntries = namedtuple('Entries', ['valid', 'potential'])
+def _open_in_browser(url, *args):
+    # the bundled webbrowser module looks for installed browsers as soon as it's imported
+    from .libs import webbrowser
+    webbrowser.open(url, *args)
 
 
 def _focus_zero_field(editor):
     # no idea why, but sometimes web seems to be unavailable
-    if editor.web:
+    if editor and editor.web:
         editor.web.eval("focusField(%d);" % 0)
 
 
+# shared by every lookup so that background fetches (e.g. the losing side of a RACE) don't hold up the caller
+_fetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="AutoDefine")
+
+
+def _run_on_main(func):
+    # Qt widgets may only be touched from the main thread; older Anki versions have no task manager to hand off to
+    taskman = getattr(mw, "taskman", None)
+    if taskman and threading.current_thread() is not threading.main_thread():
+        taskman.run_on_main(func)
+    else:
+        func()
+
+
+def _call_on_main(func):
+    # like _run_on_main, but waits for func to finish on the main thread and returns its result
+    taskman = getattr(mw, "taskman", None)
+    if not taskman or threading.current_thread() is threading.main_thread():
+        return func()
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func())
+        except Exception as e:
+            future.set_exception(e)
+
+    taskman.run_on_main(run)
+    return future.result()
+
+
+def _api_key(dictionary):
+    return MERRIAM_WEBSTER_API_KEY if dictionary == "COLLEGIATE" else MERRIAM_WEBSTER_MEDICAL_API_KEY
+
+
+_offline_pack = None
+
+# set once the pack couldn't be opened, so it's reported (and tried) only once until the next build
+_offline_pack_failed = False
+
+
+def get_offline_pack():
+    global _offline_pack, _offline_pack_failed
+    if _offline_pack is None and not _offline_pack_failed and os.path.exists(OFFLINE_PACK_PATH):
+        import struct
+        from .offline_pack import OfflinePack
+        try:
+            _offline_pack = OfflinePack(OFFLINE_PACK_PATH)
+        except (OSError, ValueError, struct.error) as e:
+            # e.g. a copy from another computer that didn't finish; words are looked up online instead
+            _offline_pack_failed = True
+            # built here, since e is gone by the time the main thread gets to show it
+            message = "AutoDefine: Couldn't open the offline pack, so it won't be used (%s). Build it again, or copy " \
+                      "it over again from the other computer." % e
+            _run_on_main(lambda: tooltip(message, period=10000))
+    return _offline_pack
+
+
+def parse_response(body, word, dictionary):
+    # Cached and packed responses may come from either API, whichever API_BACKEND was set to when they were fetched
+    from .json_api import is_json_response, parse_json_entries
+    from .parsing import parse_entries
+
+    if is_json_response(body):
+        return parse_json_entries(body, word, dictionary)
+    return parse_entries(body, word)
+
+
+# lookups of the same word in the same dictionary that overlap share one fetch
+_in_flight_lookups = SingleFlight()
+
+
+def get_dictionary_entries(dictionary, word):
+    # The key keeps the word's case: the response doesn't depend on it, but which entries are kept from it does.
+    entries, shared = _in_flight_lookups.do((dictionary, " ".join(word.split())),
+                                            lambda: _fetch_dictionary_entries(dictionary, word))
+    if shared:
+        instrumentation.count("requests_coalesced")
+        # the other caller has the same list
+        return list(entries)
+    return entries
+
+
+def _fetch_dictionary_entries(dictionary, word):
+    import urllib.parse
+
+    pack = get_offline_pack()
+    if pack:
+        body = pack.get(dictionary, word)
+        if body is not None:
+            instrumentation.count("offline_pack_hits")
+            with instrumentation.phase("parse"):
+                return parse_response(body, word, dictionary)
+
+    if API_BACKEND == "JSON":
+        from .json_api import COLLEGIATE_URL, MEDICAL_URL
+        url = (COLLEGIATE_URL if dictionary == "COLLEGIATE" else MEDICAL_URL) + \
+            urllib.parse.quote(word) + "?key=" + _api_key(dictionary)
+    elif dictionary == "COLLEGIATE":
+        url = "http://www.dictionaryapi.com/api/v1/references/collegiate/xml/" + \
+              urllib.parse.quote_plus(word) + "?key=" + _api_key(dictionary)
+    else:
+        url = "https://www.dictionaryapi.com/api/references/medical/v2/xml/" + \
+              urllib.parse.quote_plus(word) + "?key=" + _api_key(dictionary)
+    return get_entries_from_api(word, url, dictionary)
+
+
+class MerriamWebsterSource(Source):
+    def __init__(self, dictionary):
+        self.name = dictionary
+
+    def lookup(self, word):
+        return get_dictionary_entries(self.name, word)
+
+
+# The dictionaries words are looked up in. PREFERRED_DICTIONARY is always asked first, the others in priority order;
+# other add-ons can add their own sources with register_source.
+_source_registry = SourceRegistry()
+_source_registry.register(MerriamWebsterSource("COLLEGIATE"), priority=10)
+_source_registry.register(MerriamWebsterSource("MEDICAL"), priority=20)
+
+
+def register_source(source, priority=100):
+    _source_registry.register(source, priority)
+
+
+_inflection_index = None
+_spelling_index = None
+
+
+def get_inflection_index():
+    # filled in the background from every cached and packed response the first time it's needed, and with every
+    # lookup from then on
+    global _inflection_index, _spelling_index
+    if _inflection_index is None:
+        _inflection_index = InflectionIndex()
+        _spelling_index = SpellingIndex()
+        _fetch_executor.submit(_index_known_entries)
+    return _inflection_index
+
+
+def get_spelling_index():
+    # the headwords of the inflection index, for suggesting spellings of words that have no entry
+    get_inflection_index()
+    return _spelling_index
+
+
+def _add_known_entries(entries):
+    for headword in _inflection_index.add_entries(entries):
+        _spelling_index.add(headword)
+
+
+def _index_known_entries():
+    from json import JSONDecodeError
+    from xml.etree import ElementTree as ET
+    from .parsing import InvalidApiKey
+
+    cache = get_lookup_cache()
+    pack = get_offline_pack()
+    for records in (cache.items() if cache else [], pack.items() if pack else []):
+        for dictionary, word, body in records:
+            try:
+                _add_known_entries(parse_response(body, word, dictionary))
+            except (ET.ParseError, JSONDecodeError, InvalidApiKey):
+                continue
+
+
 def get_preferred_valid_entries(editor, word):
-    collegiate_url = "http://www.dictionaryapi.com/api/v1/references/collegiate/xml/" + \
-                     urllib.parse.quote_plus(word) + "?key=" + MERRIAM_WEBSTER_API_KEY
-    medical_url = "https://www.dictionaryapi.com/api/references/medical/v2/xml/" + \
-                  urllib.parse.quote_plus(word) + "?key=" + MERRIAM_WEBSTER_MEDICAL_API_KEY
-    all_collegiate_entries = get_entries_from_api(word, collegiate_url)
-    all_medical_entries = get_entries_from_api(word, medical_url)
+    from .parsing import filter_entries_lower_and_potential
+
+    index = get_inflection_index()
+    headword = index.resolve(word)
+
+    # Close known headwords are found locally before anything is fetched. A word the index doesn't know may still be
+    # in the dictionary, so they're only offered if the lookup comes back empty, in place of (or ahead of) the
+    # dictionary's own suggestions.
+    suggestions = []
+    spelling = get_spelling_index()
+    if editor and not headword and word not in spelling:
+        with instrumentation.phase("suggest"):
+            suggestions = spelling.suggest(word)
 
     potential_unified = set()
-    if PREFERRED_DICTIONARY == "COLLEGIATE":
-        entries = filter_entries_lower_and_potential(word, all_collegiate_entries)
-        potential_unified |= entries.potential
-        if not entries.valid:
-            entries = filter_entries_lower_and_potential(word, all_medical_entries)
-            potential_unified |= entries.potential
-    else:
-        entries = filter_entries_lower_and_potential(word, all_medical_entries)
-        potential_unified |= entries.potential
-        if not entries.valid:
-            entries = filter_entries_lower_and_potential(word, all_collegiate_entries)
-            potential_unified |= entries.potential
-
-    if not entries.valid:
-        potential = " Potential matches: " + ", ".join(potential_unified)
-        tooltip("No entry found in Merriam-Webster dictionary for word '%s'.%s" %
-                (word, potential if entries.potential else ""))
+
+    def lookup(lookup_word):
+        # in RACE mode every source is asked at once, otherwise the next one only when the ones before it had no
+        # entry (which spares their round trips and quota)
+        valid, potential = _source_registry.first_valid(lookup_word, filter_entries_lower_and_potential,
+                                                        _fetch_executor, preferred=PREFERRED_DICTIONARY,
+                                                        fan_out=FETCH_MODE == "RACE")
+        potential_unified.update(potential)
+        return valid
+
+    # The word as typed comes first, as an inflection like "saw" or "left" may be a headword of its own; a repeated
+    # miss costs nothing, since the negative cache has it. Only then is it looked up as a form the dictionary lists
+    # under another headword ("geese", "ran"), and failing that as a guessed base form ("hoping").
+    valid = lookup(word)
+    if not valid and headword and headword != word.lower():
+        instrumentation.count("inflections_resolved")
+        valid = lookup(headword)
+    if not valid:
+        guess = index.guess(word)
+        if guess and guess not in (word.lower(), headword):
+            instrumentation.count("inflections_guessed")
+            valid = lookup(guess)
+    if valid:
+        _add_known_entries(valid)
+
+    # batch jobs have no editor and report misses themselves once they're done
+    if not valid and editor:
+        raise WordNotFound(word, suggestions + sorted(potential_unified.difference(suggestions)))
+    return valid
+
+
+def _show_not_found(editor, word, suggestions, force_pronounce=False, force_definition=False,
+                    force_phonetic_transcription=False):
+    if not suggestions:
+        tooltip("No entry found in Merriam-Webster dictionary for word '%s'." % word)
         _focus_zero_field(editor)
-    return entries.valid
-
-
-def filter_entries_lower_and_potential(word, all_entries):
-    valid_entries = extract_valid_entries(word, all_entries)
-    maybe_entries = set()
-    if not valid_entries:
-        valid_entries = extract_valid_entries(word, all_entries, True)
-        if not valid_entries:
-            for entry in all_entries:
-                maybe_entries.add(re.sub(r'\[\d+\]$', "", entry.attrib["id"]))
-    return ValidAndPotentialEntries(valid_entries, maybe_entries)
-
-
-def extract_valid_entries(word, all_entries, lower=False):
-    valid_entries = []
-    for entry in all_entries:
-        if lower:
-            if entry.attrib["id"][:len(word) + 1].lower() == word.lower() + "[" \
-                    or entry.attrib["id"].lower() == word.lower():
-                valid_entries.append(entry)
-        else:
-            if entry.attrib["id"][:len(word) + 1] == word + "[" \
-                    or entry.attrib["id"] == word:
-                valid_entries.append(entry)
-    return valid_entries
+        return
+
+    # picking a suggestion defines it right away, filling the same fields the original press asked for
+    note = editor.note
+    forced = (force_pronounce, force_definition, force_phonetic_transcription)
+    menu = QMenu(editor.widget)
+    header = menu.addAction("No entry for '%s'. Did you mean:" % word)
+    header.setEnabled(False)
+    for suggestion in suggestions[:10]:
+        action = menu.addAction(suggestion)
+        action.triggered.connect(lambda _=False, suggestion=suggestion: _define_suggestion(editor, note, word,
+                                                                                           suggestion, *forced))
+    menu.popup(QCursor.pos())
+
+
+def _define_suggestion(editor, note, word, suggestion, force_pronounce=False, force_definition=False,
+                       force_phonetic_transcription=False):
+    # the editor may have moved on to a different note while the menu was open
+    if note is None or editor.note is not note:
+        return
+    # fix the spelling on the card too, unless the word was just selected somewhere in a longer text
+    if note.fields and clean_html(note.fields[0]).strip() == word:
+        note.fields[0] = suggestion
+        editor.loadNote()
+    _get_definition(editor, force_pronounce, force_definition, force_phonetic_transcription, word=suggestion)
+
+
+_lookup_cache = None
+
+_invocation_log = InvocationLog(TIMINGS_TO_KEEP)
+
+# how long importing the add-on took when Anki started, set by __init__
+startup_seconds = None
+
+_connection_pool = None
+
+_api_quota = None
+
+
+def get_connection_pool():
+    # shared by every lookup, so consecutive requests to the same host skip the TCP and TLS handshakes
+    global _connection_pool
+    if _connection_pool is None:
+        from .network import ConnectionPool
+        _connection_pool = ConnectionPool(USER_AGENT)
+    return _connection_pool
+
+
+def get_api_quota():
+    global _api_quota
+    if _api_quota is None:
+        _api_quota = ApiQuota(os.path.join(USER_FILES_DIR, "api_usage.json"), DAILY_API_LIMIT, MAX_REQUESTS_PER_SECOND)
+    return _api_quota
+
+
+def get_lookup_cache():
+    # opened lazily so that the user's config has been read before we decide whether caching is on
+    global _lookup_cache
+    if _lookup_cache is None and CACHE_TTL_DAYS > 0 and CACHE_MAX_ENTRIES > 0:
+        from .cache import LookupCache
+        _lookup_cache = LookupCache(os.path.join(USER_FILES_DIR, "lookup_cache.sqlite3"),
+                                    CACHE_TTL_DAYS * 24 * 60 * 60, CACHE_MAX_ENTRIES,
+                                    NEGATIVE_CACHE_TTL_DAYS * 24 * 60 * 60)
+    return _lookup_cache
+
 
+def get_entries_from_api(word, url, dictionary=None):
+    from http.client import RemoteDisconnected
+    from json import JSONDecodeError
+    from urllib.error import URLError
+    from xml.etree import ElementTree as ET
+    from .parsing import InvalidApiKey, extract_valid_entries
 
-def get_entries_from_api(word, url):
     if "YOUR_KEY_HERE" in url:
         return []
+    cache = get_lookup_cache() if dictionary else None
     try:
-        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:62.0)'
-                                                                 ' Gecko/20100101 Firefox/62.0'})
-        returned = urllib.request.urlopen(req).read()
-        if "Invalid API key" in returned.decode("UTF-8"):
-            showInfo("API key '%s' is invalid. Please double-check you are using the key labeled \"Key (Dictionary)\". "
-                     "A web browser with the web page that lists your keys will open." % url.split("?key=")[1])
-            webbrowser.open("https://www.dictionaryapi.com/account/my-keys.htm")
-            return []
-        if "Results not found" in returned.decode("UTF-8"):
-            return []
-        etree = ET.fromstring(returned)
-        return etree.findall("entry")
-    except URLError:
+        returned = cache.get(dictionary, word) if cache else None
+        from_cache = returned is not None
+        if not from_cache and cache:
+            suggestions = cache.get_miss(dictionary, word)
+            if suggestions is not None:
+                instrumentation.count("negative_cache_hits")
+                # entries with nothing but an id are what parse_entries leaves of the ones that don't match
+                return [ET.Element("entry", id=suggestion) for suggestion in suggestions]
+        if from_cache:
+            instrumentation.count("cache_hits")
+        else:
+            if cache:
+                instrumentation.count("cache_misses")
+            get_api_quota().acquire(url.split("?key=")[1])
+            with instrumentation.phase("network"):
+                returned = get_connection_pool().get(url, REQUEST_TIMEOUT_SECONDS)
+            instrumentation.count("api_calls")
+            instrumentation.count("bytes_downloaded", len(returned))
+        with instrumentation.phase("parse"):
+            entries = parse_response(returned, word, dictionary)
+        if cache and not from_cache:
+            # only cache responses that parsed, so a truncated download doesn't stick around for CACHE_TTL_DAYS
+            if extract_valid_entries(word, entries, lower=True):
+                cache.put(dictionary, word, returned)
+            else:
+                cache.put_miss(dictionary, word, [entry.attrib["id"] for entry in entries])
+        return entries
+    except InvalidApiKey:
+        _run_on_main(lambda: _show_invalid_key(url.split("?key=")[1]))
+        return []
+    except (ET.ParseError, JSONDecodeError, RemoteDisconnected):
+        stack_trace = traceback.format_exc()
+        _run_on_main(lambda: _show_parse_error(word, url, stack_trace))
         return []
-    except (ET.ParseError, RemoteDisconnected):
-        showInfo("Couldn't parse API response for word '%s'. "
-                 "Please submit an issue to the AutoDefine GitHub (a web browser window will open)." % word)
-        webbrowser.open("https://github.com/z1lc/AutoDefine/issues/new?title=Parse error for word '%s'"
-                        "&body=Anki Version: %s%%0APlatform: %s %s%%0AURL: %s%%0AStack Trace: %s"
-                        % (word, version, platform.system(), platform.release(), url, traceback.format_exc()), 0, False)
+    except (URLError, OSError) as e:
+        # OSError covers socket timeouts and refused connections, which http.client doesn't wrap in a URLError
+        raise LookupFailed(str(e))
+
+
+def _show_invalid_key(key):
+    showInfo("API key '%s' is invalid. Please double-check you are using the key labeled \"Key (Dictionary)\". "
+             "A web browser with the web page that lists your keys will open." % key)
+    _open_in_browser("https://www.dictionaryapi.com/account/my-keys.htm")
+
+
+def _show_parse_error(word, url, stack_trace):
+    showInfo("Couldn't parse API response for word '%s'. "
+             "Please submit an issue to the AutoDefine GitHub (a web browser window will open)." % word)
+    _open_in_browser("https://github.com/z1lc/AutoDefine/issues/new?title=Parse error for word '%s'"
+                     "&body=Anki Version: %s%%0APlatform: %s %s%%0AURL: %s%%0AStack Trace: %s"
+                     % (word, version, platform.system(), platform.release(), url, stack_trace), 0, False)
 
 
 def _get_word(editor):
@@ -244,161 +602,392 @@ def _get_word(editor):
     return word
 
 
+def _split_selection(text):
+    # "obdurate, obstinate; Obdurate" -> ["obdurate", "obstinate"]
+    words = {}
+    for word in re.split(r"[\s,;/]+", text):
+        word = word.strip(".:!?\"'()[]")
+        if word and word.lower() not in words:
+            words[word.lower()] = word
+    return list(words.values())
+
+
+class LookupCancelled(Exception):
+    pass
+
+
+class LookupFailed(Exception):
+    # the dictionary couldn't be reached; unlike an empty result, this says nothing about whether the word has an entry
+    pass
+
+
+class WordNotFound(Exception):
+    # an editor lookup found no entry; the editor offers what might have been meant instead, if the result still counts
+    def __init__(self, word, suggestions):
+        super().__init__(word)
+        self.word = word
+        self.suggestions = suggestions
+
+
+# bumped on every AutoDefine press, so a worker still busy with an earlier press knows its result is no longer wanted
+_lookup_generation = 0
+
+
+def _check_cancelled(generation):
+    # batch jobs pass no generation, since pressing the editor button shouldn't cancel them
+    if generation is not None and generation != _lookup_generation:
+        raise LookupCancelled()
+
+
+def _run_in_background(task, on_done):
+    # older Anki versions have no task manager, so there the lookup still blocks the window like it used to
+    taskman = getattr(mw, "taskman", None)
+    if taskman:
+        taskman.run_in_background(task, on_done)
+        return
+    future = Future()
+    try:
+        future.set_result(task())
+    except Exception as e:
+        future.set_exception(e)
+    on_done(future)
+
+
 def _get_definition(editor,
                     force_pronounce=False,
                     force_definition=False,
-                    force_phonetic_transcription=False):
+                    force_phonetic_transcription=False,
+                    word=None):
+    global _lookup_generation
     validate_settings()
-    word = _get_word(editor)
+    word = word or _get_word(editor)
     if word == "":
         tooltip("AutoDefine: No text found in note fields.")
         return
-    valid_entries = get_preferred_valid_entries(editor, word)
+
+    words = [word]
+    if SPLIT_SELECTION and editor.web and editor.web.selectedText():
+        words = _split_selection(word) or words
+
+    _lookup_generation += 1
+    generation = _lookup_generation
+    note = editor.note
+    invocation = Invocation("editor", word)
+
+    # the note type has to be inspected here, since the collection belongs to the main thread
+    layout = get_field_layout(editor.note.model())
+    reused = None
+    if len(words) == 1:
+        reused = _reuse_from_collection(note, word, layout, force_pronounce, force_definition,
+                                        force_phonetic_transcription)
+
+    def lookup():
+        with instrumentation.activate(invocation):
+            if reused is not None:
+                instrumentation.count("collection_hits")
+                return reused
+            if len(words) > 1:
+                return _lookup_selection(words, generation, layout, force_pronounce, force_definition,
+                                         force_phonetic_transcription)
+            return _lookup_definition(editor, word, generation, layout, force_pronounce,
+                                      force_definition, force_phonetic_transcription)
+
+    def on_done(future):
+        with instrumentation.activate(invocation):
+            apply_result(future)
+        invocation.finish()
+        _invocation_log.add(invocation)
+
+    def apply_result(future):
+        # drop the result if the user pressed AutoDefine again or moved on to a different note in the meantime
+        if generation != _lookup_generation or editor.note is not note:
+            instrumentation.count("discarded")
+            return
+        try:
+            insert_queue = future.result()
+        except LookupCancelled:
+            return
+        except WordNotFound as e:
+            _show_not_found(editor, e.word, e.suggestions, force_pronounce, force_definition,
+                            force_phonetic_transcription)
+            return
+        except QuotaExceeded:
+            tooltip("AutoDefine: You've used all %d lookups for today. Try again tomorrow, or raise DAILY_API_LIMIT "
+                    "in the Add-on configuration if your key allows more." % DAILY_API_LIMIT, period=10000)
+            return
+        except LookupFailed as e:
+            tooltip("AutoDefine: Couldn't reach dictionaryapi.com (%s). Check your internet connection and try again."
+                    % e, period=10000)
+            return
+
+        # Insert each queue into the considered field
+        with instrumentation.phase("insert"):
+            insert_into_fields(editor, insert_queue)
+
+        if OPEN_IMAGES_IN_BROWSER:
+            _open_in_browser("https://www.google.com/search?q= " + word + "&safe=off&tbm=isch&tbs=isz:lt,islt:xga", 0,
+                             False)
+
+    _run_in_background(lookup, on_done)
+
+
+def _wanted_fields(force_pronounce=False, force_definition=False, force_phonetic_transcription=False):
+    # whether the pronunciation, phonetic transcription and definition are to be added
+    return ((not force_definition and not force_phonetic_transcription and PRONUNCIATION_FIELD > -1) or force_pronounce,
+            (not force_definition and not force_pronounce and PHONETIC_TRANSCRIPTION_FIELD > -1) or
+            force_phonetic_transcription,
+            (not force_pronounce and not force_phonetic_transcription and DEFINITION_FIELD > -1) or force_definition)
+
+
+# Runs on a background thread: fetches, parses and renders everything for the word, and returns the text to add to
+# each field. Nothing in here may touch Qt or the editor's note.
+def _lookup_definition(editor,
+                       word,
+                       generation,
+                       layout,
+                       force_pronounce=False,
+                       force_definition=False,
+                       force_phonetic_transcription=False):
+    with instrumentation.phase("lookup"):
+        valid_entries = get_preferred_valid_entries(editor, word)
+    _check_cancelled(generation)
 
     insert_queue = {}
+    wants_pronunciation, wants_phonetic_transcription, wants_definition = \
+        _wanted_fields(force_pronounce, force_definition, force_phonetic_transcription)
 
     # Add Vocal Pronunciation
-    if (not force_definition and not force_phonetic_transcription and PRONUNCIATION_FIELD > -1) or force_pronounce:
-        # Parse all unique pronunciations, and convert them to URLs as per http://goo.gl/nL0vte
-        all_sounds = []
-        for entry in valid_entries:
-            for wav in entry.findall("sound/wav"):
-                raw_wav = wav.text
-                # API-specific URL conversions
-                if raw_wav[:3] == "bix":
-                    mid_url = "bix"
-                elif raw_wav[:2] == "gg":
-                    mid_url = "gg"
-                elif raw_wav[:1].isdigit():
-                    mid_url = "number"
-                else:
-                    mid_url = raw_wav[:1]
-                wav_url = "http://media.merriam-webster.com/soundc11/" + mid_url + "/" + raw_wav
-
-                all_sounds.append(editor.urlToLink(wav_url).strip())
-
-        # We want to make this a non-duplicate list, so that we only get unique sound files.
-        all_sounds = list(dict.fromkeys(all_sounds))
-
-        final_pronounce_index = PRONUNCIATION_FIELD
-        fields = mw.col.models.fieldNames(editor.note.model())
-        for field in fields:
-            if '🔊' in field:
-                final_pronounce_index = fields.index(field)
-                break
+    if wants_pronunciation:
+        with instrumentation.phase("pronunciation"):
+            to_print = ''.join(_sounds_to_links(sound_urls(valid_entries)))
+        _check_cancelled(generation)
 
-        to_print = ''.join(all_sounds)
-
-        _add_to_insert_queue(insert_queue, to_print, final_pronounce_index)
+        _add_to_insert_queue(insert_queue, to_print, layout.pronunciation)
 
     # Add Phonetic Transcription
-    if (not force_definition and not force_pronounce and PHONETIC_TRANSCRIPTION_FIELD > -1) or \
-            force_phonetic_transcription:
+    if wants_phonetic_transcription:
+        with instrumentation.phase("phonetic"):
+            to_print = render_phonetic_transcriptions(valid_entries, PART_OF_SPEECH_ABBREVIATION)
+        _add_to_insert_queue(insert_queue, to_print, layout.phonetic_transcription)
 
-        # extract phonetic transcriptions for each entry and label them by part of speech
-        all_transcriptions = []
-        for entry in valid_entries:
-            if entry.find("pr") is not None:
-                phonetic_transcription = entry.find("pr").text
+    # Add Definition
+    if wants_definition:
+        with instrumentation.phase("definition"):
+            to_return = render_definitions(valid_entries, IGNORE_ARCHAIC, PART_OF_SPEECH_ABBREVIATION)
+        _add_to_insert_queue(insert_queue, to_return, layout.definition)
+
+    return insert_queue
+
+
+# Like _lookup_definition, but for several words selected at once: they're all looked up at the same time, and what
+# each one adds to a field is merged in the order the words were selected.
+def _lookup_selection(words,
+                      generation,
+                      layout,
+                      force_pronounce=False,
+                      force_definition=False,
+                      force_phonetic_transcription=False):
+    with ThreadPoolExecutor(max_workers=min(len(words), max(1, BULK_WORKERS)),
+                            thread_name_prefix="AutoDefine-selection") as executor:
+        # without an editor, words that aren't found are reported below instead of one at a time
+        futures = [executor.submit(instrumentation.in_current_context(_lookup_definition), None, word, generation,
+                                   layout, force_pronounce, force_definition, force_phonetic_transcription)
+                   for word in words]
+        word_queues = [future.result() for future in futures]
+    _check_cancelled(generation)
 
-                part_of_speech = entry.find("fl").text
-                part_of_speech = _abbreviate_part_of_speech(part_of_speech)
+    insert_queue = {}
+    not_found = []
+    for word, word_queue in zip(words, word_queues):
+        if not any(word_queue.values()):
+            not_found.append(word)
+            continue
+        for field_index, to_print in word_queue.items():
+            if not to_print:
+                continue
+            if field_index == layout.definition:
+                # the definitions of different words would be hard to tell apart otherwise
+                to_print = "<b>%s</b>: %s" % (word, to_print)
+            _add_to_insert_queue(insert_queue, to_print, field_index)
 
-                row = f'<b>{part_of_speech}</b> \\{phonetic_transcription}\\'
-                all_transcriptions.append(row)
+    if not_found:
+        _run_on_main(lambda: tooltip("No entry found in Merriam-Webster dictionary for: " + ", ".join(not_found)))
+    return insert_queue
 
-        to_print = "<br>".join(all_transcriptions)
 
-        _add_to_insert_queue(insert_queue, to_print, PHONETIC_TRANSCRIPTION_FIELD)
+# Definitions already in the collection. Read from the collection a chunk at a time once the first editor opens (or
+# the first lookup asks for them), and kept current by the note hooks from then on. Only used from the main thread,
+# since the collection belongs to it.
+_collection_index = None
 
-    # Add Definition
-    definition_array = []
-    if (not force_pronounce and not force_phonetic_transcription and DEFINITION_FIELD > -1) or force_definition:
-        # Extract the type of word this is
-        for entry in valid_entries:
-            this_def = entry.find("def")
-            if entry.find("fl") is None:
+# notes read from the collection per chunk, small enough for each one to go unnoticed in the editor
+COLLECTION_INDEX_CHUNK = 500
+
+
+def get_collection_index():
+    global _collection_index
+    if _collection_index is None:
+        _collection_index = CollectionIndex()
+        _index_collection_notes(_collection_index, 0, {})
+    return _collection_index
+
+
+def _index_collection_notes(index, after_id, layouts):
+    # reads the next chunk of notes (by id) and schedules the one after it, so the editor stays responsive in between
+    if index is not _collection_index or mw.col is None:
+        # the profile was closed in the meantime
+        return
+    rows = mw.col.db.all("select id, mid, flds, mod from notes where id > ? order by id limit ?", after_id,
+                         COLLECTION_INDEX_CHUNK)
+    for note_id, model_id, fields, modified in rows:
+        if model_id not in layouts:
+            model = mw.col.models.get(model_id)
+            layouts[model_id] = get_field_layout(model) if model else None
+        if layouts[model_id]:
+            _index_note_fields(index, note_id, fields.split("\x1f"), layouts[model_id], modified)
+    if len(rows) < COLLECTION_INDEX_CHUNK:
+        index.ready = True
+        return
+    mw.progress.timer(10, lambda: _index_collection_notes(index, rows[-1][0], layouts), False)
+
+
+_SOUND_TAG = re.compile(r"\[sound:[^\]]+\]")
+
+
+def _index_note_fields(index, note_id, fields, layout, modified):
+    def field(field_index):
+        return fields[field_index] if 0 <= field_index < len(fields) else ""
+
+    # The pronunciation usually shares the first field with the word itself, so only its recordings are kept, and the
+    # word is what's left of the first field without them.
+    pronunciation = "".join(_SOUND_TAG.findall(field(layout.pronunciation)))
+    word = _SOUND_TAG.sub("", clean_html(field(0))).strip()
+    index.add(note_id, word, pronunciation, field(layout.definition), field(layout.phonetic_transcription), modified)
+
+
+def _index_note(note, *args):
+    # notes that haven't been added yet (id 0) only count once they are; the note was just changed, so it's newer
+    # than anything read from the collection
+    if _collection_index is not None and note.id and note.fields:
+        _index_note_fields(_collection_index, note.id, note.fields, get_field_layout(note.model()), int(time.time()))
+
+
+def _on_focus_lost(changed, note, field_index):
+    # editFocusLost is a filter; notes are indexed once a field is left, rather than on every keystroke like editTimer
+    _index_note(note)
+    return changed
+
+
+def _forget_notes(col, note_ids, *args):
+    if _collection_index is not None:
+        _collection_index.remove(note_ids)
+
+
+def _clear_collection_index(*args):
+    global _collection_index
+    _collection_index = None
+
+
+def _reuse_from_collection(note, word, layout, force_pronounce=False, force_definition=False,
+                           force_phonetic_transcription=False):
+    # The fields another note for the same word already has, as an insert queue, or None if the dictionary has to be
+    # asked. Only used if that note has everything this lookup would add, so it never gives less than the dictionary.
+    index = get_collection_index()
+    if not index.ready:
+        return None
+    wanted = _wanted_fields(force_pronounce, force_definition, force_phonetic_transcription)
+    parts = (("pronunciation", layout.pronunciation), ("phonetic_transcription", layout.phonetic_transcription),
+             ("definition", layout.definition))
+    parts = [part for wants, part in zip(wanted, parts) if wants]
+    known = index.get(word, [field for field, _ in parts], exclude_note_id=note.id)
+    if known is None or not parts:
+        return None
+    insert_queue = {}
+    for field, field_index in parts:
+        _add_to_insert_queue(insert_queue, getattr(known, field), field_index)
+    return insert_queue
+
+
+_audio_store = None
+
+# separate from _fetch_executor, so a lookup waiting on its downloads can never be queued behind itself
+_audio_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="AutoDefine-audio")
+
+
+def get_audio_store():
+    global _audio_store
+    if _audio_store is None:
+        _audio_store = AudioStore(os.path.join(USER_FILES_DIR, "audio"), AUDIO_CACHE_MB * 1024 * 1024)
+    return _audio_store
+
+
+def _download_sound(wav_url):
+    from urllib.error import URLError
+
+    filename = wav_url.split("/")[-1]
+    store = get_audio_store()
+    data = store.get(filename)
+    if data is None:
+        try:
+            with instrumentation.phase("audio_download"):
+                data = get_connection_pool().get(wav_url, REQUEST_TIMEOUT_SECONDS)
+        except (URLError, OSError):
+            return None
+        instrumentation.count("audio_bytes_downloaded", len(data))
+        store.put(filename, data)
+    else:
+        instrumentation.count("audio_store_hits")
+    return data
+
+
+def _sounds_to_links(wav_urls):
+    # Does the same as editor.urlToLink for every URL, but downloads them all at once and is safe to call off the main
+    # thread. Files already in the collection's media folder (from an earlier note) aren't downloaded again.
+    media = mw.col.media
+    media_dir = media.dir()
+    filenames = [wav_url.split("/")[-1] for wav_url in wav_urls]
+    downloads = {}
+    for wav_url, filename in zip(wav_urls, filenames):
+        if not os.path.exists(os.path.join(media_dir, filename)):
+            downloads[filename] = _audio_executor.submit(instrumentation.in_current_context(_download_sound), wav_url)
+
+    write_data = getattr(media, "write_data", None) or media.writeData
+    links = []
+    for filename in filenames:
+        if filename in downloads:
+            data = downloads[filename].result()
+            if data is None:
                 continue
-            fl = entry.find("fl").text
-            fl = _abbreviate_part_of_speech(fl)
-
-            this_def.tail = "<b>" + fl + "</b>"  # save the functional label (noun/verb/etc) in the tail
-
-            # the <ssl> tag will contain the word 'obsolete' if the term is not in use anymore. However, for some
-            # reason, the tag precedes the <dt> that it is associated with instead of being a child. We need to
-            # associate it here so that later we can either remove or keep it regardless.
-            previous_was_ssl = False
-            for child in this_def:
-                # this is a kind of poor way of going about things, but the ElementTree API
-                # doesn't seem to offer an alternative.
-                if child.text == "obsolete" and child.tag == "ssl":
-                    previous_was_ssl = True
-                if previous_was_ssl and child.tag == "dt":
-                    child.tail = "obsolete"
-                    previous_was_ssl = False
-
-            definition_array.append(this_def)
-
-        to_return = ""
-        for definition in definition_array:
-            last_functional_label = ""
-            medical_api_def = definition.findall("./sensb/sens/dt")
-            # sometimes there's not a definition directly (dt) but just a usage example (un):
-            if len(medical_api_def) == 1 and not medical_api_def[0].text:
-                medical_api_def = definition.findall("./sensb/sens/dt/un")
-            for dtTag in (definition.findall("dt") + medical_api_def):
-
-                if dtTag.tail == "obsolete":
-                    dtTag.tail = ""  # take away the tail word so that when printing it does not show up.
-                    if IGNORE_ARCHAIC:
-                        continue
-
-                # We don't really care for 'verbal illustrations' or 'usage notes',
-                # even though they are occasionally useful.
-                for usageNote in dtTag.findall("un"):
-                    dtTag.remove(usageNote)
-                for verbalIllustration in dtTag.findall("vi"):
-                    dtTag.remove(verbalIllustration)
-
-                # Directional cross reference doesn't make sense for us
-                for dxTag in dtTag.findall("dx"):
-                    for dxtTag in dxTag.findall("dxt"):
-                        for dxnTag in dxtTag.findall("dxn"):
-                            dxtTag.remove(dxnTag)
-
-                # extract raw XML from <dt>...</dt>
-                to_print = ET.tostring(dtTag, "", "xml").strip().decode("utf-8")
-                # attempt to remove 'synonymous cross reference tag' and replace with semicolon
-                to_print = to_print.replace("<sx>", "; ")
-                # attempt to remove 'Directional cross reference tag' and replace with semicolon
-                to_print = to_print.replace("<dx>", "; ")
-                # remove all other XML tags
-                to_print = re.sub('<[^>]*>', '', to_print)
-                # remove all colons, since they are usually useless and have been replaced with semicolons above
-                to_print = re.sub(':', '', to_print)
-                # erase space between semicolon and previous word, if exists, and strip any extraneous whitespace
-                to_print = to_print.replace(" ; ", "; ").strip()
-                to_print += "\n<br>"
-
-                # add verb/noun/adjective
-                if last_functional_label != definition.tail:
-                    to_print = definition.tail + " " + to_print
-                last_functional_label = definition.tail
-                to_return += to_print
-
-        # final cleanup of <sx> tag bs
-        to_return = to_return.replace(".</b> ; ", ".</b> ")  # <sx> as first definition after "n. " or "v. "
-        to_return = to_return.replace("\n; ", "\n")  # <sx> as first definition after newline
-        _add_to_insert_queue(insert_queue, to_return, DEFINITION_FIELD)
-
-    # Insert each queue into the considered field
-    for field_index in insert_queue.keys():
-        insert_into_field(editor, insert_queue[field_index], field_index)
-
-    if OPEN_IMAGES_IN_BROWSER:
-        webbrowser.open("https://www.google.com/search?q= " + word + "&safe=off&tbm=isch&tbs=isz:lt,islt:xga", 0, False)
-
-    _focus_zero_field(editor)
+            filename = write_data(filename, data)
+        links.append("[sound:%s]" % filename)
+    return links
+
+
+FieldLayout = namedtuple("FieldLayout", ["pronunciation", "definition", "phonetic_transcription"])
+
+# Keyed by note type id and modification time, so an edited note type is looked at again even where the newModel hook
+# doesn't fire. Only used from the main thread.
+_field_layouts = {}
+
+
+def get_field_layout(model):
+    # which field of this note type each part of a lookup goes into
+    key = (model["id"], model.get("mod"))
+    layout = _field_layouts.get(key)
+    if layout is None:
+        fields = mw.col.models.fieldNames(model)
+        pronunciation = PRONUNCIATION_FIELD
+        for index, field in enumerate(fields):
+            if '🔊' in field:
+                pronunciation = index
+                break
+        layout = FieldLayout(pronunciation, DEFINITION_FIELD, PHONETIC_TRANSCRIPTION_FIELD)
+        _field_layouts[key] = layout
+    return layout
+
+
+def _clear_field_layouts(*args):
+    _field_layouts.clear()
 
 
 def _add_to_insert_queue(insert_queue, to_print, field_index):
@@ -408,24 +997,42 @@ def _add_to_insert_queue(insert_queue, to_print, field_index):
         insert_queue[field_index] += "<br>" + to_print
 
 
-def _abbreviate_part_of_speech(part_of_speech):
-    if part_of_speech in PART_OF_SPEECH_ABBREVIATION.keys():
-        part_of_speech = PART_OF_SPEECH_ABBREVIATION[part_of_speech]
-
-    return part_of_speech
-
-
 def insert_into_field(editor, text, field_id, overwrite=False):
-    if len(editor.note.fields) <= field_id:
-        tooltip("AutoDefine: Tried to insert '%s' into user-configured field number %d (0-indexed), but note type only "
-                "has %d fields. Use a different note type with %d or more fields, or change the index in the "
-                "Add-on configuration." % (text, field_id, len(editor.note.fields), field_id + 1), period=10000)
+    insert_into_fields(editor, {field_id: text}, overwrite)
+
+
+def insert_into_fields(editor, insert_queue, overwrite=False):
+    # Every field is written to the note first and the editor reloads once at the end, since each reload re-renders
+    # the whole note in the webview. The reload also moves the focus to the first field, saving a separate round trip.
+    changed = False
+    for field_id, text in insert_queue.items():
+        if not text and not overwrite:
+            continue
+        if _insert_into_note_field(editor.note, text, field_id, overwrite):
+            changed = True
+        else:
+            tooltip("AutoDefine: Tried to insert '%s' into user-configured field number %d (0-indexed), but note type "
+                    "only has %d fields. Use a different note type with %d or more fields, or change the index in the "
+                    "Add-on configuration." % (text, field_id, len(editor.note.fields), field_id + 1), period=10000)
+    if not changed:
+        _focus_zero_field(editor)
         return
+    try:
+        editor.loadNote(focusTo=0)
+    except TypeError:
+        # Anki versions whose loadNote can't focus a field
+        editor.loadNote()
+        _focus_zero_field(editor)
+
+
+def _insert_into_note_field(note, text, field_id, overwrite=False):
+    if len(note.fields) <= field_id:
+        return False
     if overwrite:
-        editor.note.fields[field_id] = text
+        note.fields[field_id] = text
     else:
-        editor.note.fields[field_id] += text
-    editor.loadNote()
+        note.fields[field_id] += text
+    return True
 
 
 # via https://stackoverflow.com/a/12982689
@@ -434,6 +1041,9 @@ def clean_html(raw_html):
 
 
 def setup_buttons(buttons, editor):
+    load_config()
+    # so it's complete by the time AutoDefine is pressed
+    get_collection_index()
     both_button = editor.addButton(icon=os.path.join(os.path.dirname(__file__), "images", "icon16.png"),
                                    cmd="AD",
                                    func=get_definition,
@@ -481,9 +1091,450 @@ def setup_buttons(buttons, editor):
     return buttons
 
 
-addHook("setupEditorButtons", setup_buttons)
+# the first-field text most recently seen by the prefetcher; any prefetch for a different word is stale
+_prefetch_word = ""
+
+# Separate from _fetch_executor, since a prefetch in RACE mode hands its other dictionary's lookup to that one and waits
+# for it; were prefetches running there as well, all of its workers could end up waiting on lookups queued behind them.
+# One at a time is enough, as only the latest word is prefetched anyway.
+_prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="AutoDefine-prefetch")
+
+
+def on_edit_timer(note):
+    global _prefetch_word
+    load_config()
+    if not PREFETCH_WHILE_TYPING or not note.fields:
+        return
+    word = clean_html(note.fields[0]).strip()
+    if word == _prefetch_word:
+        return
+    _prefetch_word = word
+    if word != "":
+        # editTimer already waits for a pause in typing; this waits a little longer so half-typed words are skipped
+        mw.progress.timer(PREFETCH_DELAY_MS, lambda: _start_prefetch(word), False)
+
+
+def _start_prefetch(word):
+    if word != _prefetch_word:
+        return
+    cache = get_lookup_cache()
+    if cache is None or cache.contains(PREFERRED_DICTIONARY, word):
+        return
+    quota = get_api_quota()
+    if quota.remaining(_api_key(PREFERRED_DICTIONARY)) <= DAILY_API_LIMIT * PREFETCH_QUOTA_RESERVE:
+        return
+    _prefetch_executor.submit(_prefetch, word)
+
+
+def _prefetch(word):
+    # the user may have kept typing while this sat in the executor's queue
+    if word != _prefetch_word:
+        return
+    invocation = Invocation("prefetch", word)
+    try:
+        with instrumentation.activate(invocation):
+            get_preferred_valid_entries(None, word)
+    except (QuotaExceeded, LookupFailed):
+        pass
+    invocation.finish()
+    _invocation_log.add(invocation)
+
+
+def define_selected_notes(browser):
+    validate_settings()
+    nids = browser.selectedNotes()
+    if not nids:
+        tooltip("AutoDefine: No notes selected.")
+        return
 
-if getattr(mw.addonManager, "getConfig", None):
+    # read everything the workers need up front, since the collection belongs to the main thread
+    jobs = []
+    for nid in nids:
+        note = mw.col.getNote(nid)
+        word = clean_html(note.fields[0]).strip()
+        if word != "":
+            jobs.append((note, word, get_field_layout(note.model())))
+
+    jobs = _plan_batch(jobs)
+    if not jobs:
+        return
+
+    cancelled = threading.Event()
+    out_of_quota = threading.Event()
+    unreachable = threading.Event()
+    start_time = time.time()
+    mw.progress.start(max=len(jobs), label="AutoDefine: starting...", immediate=True, parent=browser)
+
+    def update_progress(done):
+        elapsed = time.time() - start_time
+        rate = done / elapsed if elapsed > 0 else 0
+        remaining = (len(jobs) - done) / rate if rate > 0 else 0
+        mw.progress.update(label="AutoDefine: %d of %d words (%.1f words/sec, about %d:%02d remaining)"
+                                 % (done, len(jobs), rate, remaining // 60, remaining % 60),
+                           value=done)
+        if getattr(mw.progress, "want_cancel", None) and mw.progress.want_cancel():
+            cancelled.set()
+
+    def lookup(job):
+        if cancelled.is_set() or out_of_quota.is_set() or unreachable.is_set():
+            return None
+        note, word, layout = job
+        invocation = Invocation("bulk", word)
+        try:
+            with instrumentation.activate(invocation):
+                return _lookup_definition(None, word, None, layout)
+        except QuotaExceeded:
+            out_of_quota.set()
+            return None
+        except LookupFailed:
+            # left as it is, rather than counted as a word without an entry
+            unreachable.set()
+            return None
+        finally:
+            invocation.finish()
+            _invocation_log.add(invocation)
+
+    def run_jobs():
+        results = []
+        with ThreadPoolExecutor(max_workers=max(1, BULK_WORKERS), thread_name_prefix="AutoDefine-bulk") as executor:
+            futures = {executor.submit(lookup, job): job for job in jobs}
+            for done, future in enumerate(as_completed(futures), 1):
+                results.append((futures[future], future.result()))
+                _run_on_main(lambda done=done: update_progress(done))
+        return results
+
+    def on_done(future):
+        mw.progress.finish()
+        results = future.result()
+
+        # all notes are written in one go, so a single undo step reverts the whole batch
+        if getattr(mw, "checkpoint", None):
+            mw.checkpoint("AutoDefine")
+        defined = 0
+        not_found = []
+        for (note, word, _), insert_queue in results:
+            if insert_queue is None:
+                continue
+            if not any(insert_queue.values()):
+                not_found.append(word)
+                continue
+            for field_index in insert_queue.keys():
+                _insert_into_note_field(note, insert_queue[field_index], field_index)
+            note.flush()
+            _index_note(note)
+            defined += 1
+        mw.reset()
+
+        message = "AutoDefine: Defined %d of %d notes." % (defined, len(nids))
+        if out_of_quota.is_set():
+            message += " Stopped early because today's API limit was reached."
+        if unreachable.is_set():
+            message += " Stopped early because dictionaryapi.com couldn't be reached."
+        if not_found:
+            message += " No entry found for: " + ", ".join(not_found)
+        tooltip(message, period=10000)
+
+    _run_in_background(run_jobs, on_done)
+
+
+def _plan_batch(jobs):
+    # Words already in the lookup cache are free; every other word costs at least one call against the preferred
+    # dictionary's key (two in RACE mode). Rather than failing halfway through, offer to define only what fits.
+    cache = get_lookup_cache()
+    calls_per_word = 2 if FETCH_MODE == "RACE" else 1
+    budget = get_api_quota().remaining(_api_key(PREFERRED_DICTIONARY)) // calls_per_word
+    planned = []
+    for job in jobs:
+        if cache and cache.contains(PREFERRED_DICTIONARY, job[1]):
+            planned.append(job)
+        elif budget > 0:
+            planned.append(job)
+            budget -= 1
+    if len(planned) == len(jobs):
+        return jobs
+    if not planned:
+        showInfo("AutoDefine: You've used all %d API lookups for today, and none of the selected words have been "
+                 "looked up before. Try again tomorrow." % DAILY_API_LIMIT)
+        return []
+    if not askUser("AutoDefine: Defining all %d selected notes would go over today's API limit of %d lookups.\n\n"
+                   "Define the first %d notes now and leave the remaining %d for tomorrow?"
+                   % (len(jobs), DAILY_API_LIMIT, len(planned), len(jobs) - len(planned))):
+        return []
+    return planned
+
+
+def import_word_list():
+    from .word_import import ImportCheckpoint, batched, count_words, ordered_map, read_words
+
+    validate_settings()
+    path = QFileDialog.getOpenFileName(mw, "Import Word List with AutoDefine", "",
+                                       "Word lists (*.txt *.csv *.tsv);;All files (*)")[0]
+    if not path:
+        return
+
+    checkpoint = ImportCheckpoint(IMPORT_CHECKPOINT_PATH)
+    total = count_words(path)
+    progress = checkpoint.get(path)
+    if progress:
+        if progress["words_done"] >= total:
+            showInfo("AutoDefine: All %d words of this list have already been imported." % total)
+            return
+        if not askUser("AutoDefine: %d of the %d words in this list were imported before. Continue with the "
+                       "remaining %d words?" % (progress["words_done"], total, total - progress["words_done"])):
+            return
+    else:
+        # remember the note type and deck, so a resumed import keeps adding to the same place
+        progress = {"words_done": 0, "notes_added": 0, "not_found": 0,
+                    "model_id": mw.col.models.current()["id"], "deck_id": mw.col.decks.selected()}
+    model = mw.col.models.get(progress["model_id"])
+    if model is None:
+        showInfo("AutoDefine: The note type this list was being imported into no longer exists.")
+        return
+    layout = get_field_layout(model)
+
+    stop = threading.Event()
+    out_of_quota = threading.Event()
+    unreachable = threading.Event()
+    start_time = time.time()
+    first_word = progress["words_done"]
+    mw.progress.start(max=total, label="AutoDefine: starting import...", immediate=True)
+
+    def lookup(word):
+        if stop.is_set():
+            return None
+        invocation = Invocation("import", word)
+        try:
+            with instrumentation.activate(invocation):
+                return _lookup_definition(None, word, None, layout)
+        except QuotaExceeded:
+            out_of_quota.set()
+            stop.set()
+            return None
+        except LookupFailed:
+            # the import stops at this word, so resuming it looks the word up again
+            unreachable.set()
+            stop.set()
+            return None
+        finally:
+            invocation.finish()
+            _invocation_log.add(invocation)
+
+    def add_notes(results):
+        for word, insert_queue in results:
+            if not any(insert_queue.values()):
+                progress["not_found"] += 1
+                continue
+            note = Note(mw.col, model)
+            note.fields[0] = word
+            # appended like in the editor, so anything going into the first field (such as the pronunciation, by
+            # default) ends up after the word rather than in its place
+            for field_index in insert_queue.keys():
+                _insert_into_note_field(note, insert_queue[field_index], field_index)
+            if not note.fields[0].startswith(word):
+                note.fields[0] = word + note.fields[0]
+            if getattr(mw.col, "add_note", None):
+                mw.col.add_note(note, progress["deck_id"])
+            else:
+                note.model()["did"] = progress["deck_id"]
+                mw.col.addNote(note)
+            _index_note(note)
+            progress["notes_added"] += 1
+        progress["words_done"] += len(results)
+        # the collection has to have the notes before the checkpoint says they're there
+        if getattr(mw.col, "autosave", None):
+            mw.col.autosave()
+        checkpoint.save(path, progress)
+
+        elapsed = time.time() - start_time
+        rate = (progress["words_done"] - first_word) / elapsed if elapsed > 0 else 0
+        remaining = (total - progress["words_done"]) / rate if rate > 0 else 0
+        mw.progress.update(label="AutoDefine: imported %d of %d words (%.1f words/sec, about %d:%02d remaining)"
+                                 % (progress["words_done"], total, rate, remaining // 60, remaining % 60),
+                           value=progress["words_done"])
+        if getattr(mw.progress, "want_cancel", None) and mw.progress.want_cancel():
+            stop.set()
+
+    def run_import():
+        # words -> lookups (at most two batches ahead) -> batches of notes, all pulled one at a time
+        results = ordered_map(lookup, read_words(path, skip=first_word), max(1, BULK_WORKERS),
+                              2 * IMPORT_BATCH_SIZE)
+        try:
+            for batch in batched(results, IMPORT_BATCH_SIZE):
+                # stop at the first word that wasn't looked up, so the checkpoint never skips past it
+                complete = list(takewhile(lambda result: result[1] is not None, batch))
+                _call_on_main(lambda: add_notes(complete))
+                if len(complete) < len(batch) or stop.is_set():
+                    break
+        finally:
+            stop.set()
+            results.close()
+
+    def on_done(future):
+        mw.progress.finish()
+        mw.reset()
+        future.result()
+
+        message = "AutoDefine: Imported %d of %d words, adding %d notes." \
+                  % (progress["words_done"], total, progress["notes_added"])
+        if progress["not_found"]:
+            message += " %d words had no dictionary entry." % progress["not_found"]
+        if progress["words_done"] >= total:
+            checkpoint.clear(path)
+        elif out_of_quota.is_set():
+            message += "\n\nStopped because today's API limit was reached. Import the same file again tomorrow to " \
+                       "continue where this import left off."
+        elif unreachable.is_set():
+            message += "\n\nStopped because dictionaryapi.com couldn't be reached. Import the same file again once " \
+                       "you're back online to continue where this import left off."
+        else:
+            message += "\n\nImport the same file again to continue where this import left off."
+        showInfo(message)
+
+    _run_in_background(run_import, on_done)
+
+
+def show_api_usage():
+    load_config()
+    quota = get_api_quota()
+    lines = ["AutoDefine API usage today (resets at midnight):", ""]
+    for label, dictionary in (("Collegiate", "COLLEGIATE"), ("Medical", "MEDICAL")):
+        if _api_key(dictionary) == "YOUR_KEY_HERE":
+            lines.append("%s: no API key configured" % label)
+        else:
+            lines.append("%s: %d of %d lookups used" % (label, quota.used(_api_key(dictionary)), DAILY_API_LIMIT))
+    cache = get_lookup_cache()
+    if cache:
+        lines += ["", "Lookup cache: %d words, %d hits and %d misses this session"
+                  % (len(cache), cache.hits, cache.misses)]
+    showInfo("\n".join(lines))
+
+
+def build_offline_pack():
+    global _offline_pack, _offline_pack_failed
+    import struct
+    from .offline_pack import OfflinePack, build_pack, read_recorded_responses
+
+    load_config()
+    records = []
+    cache = get_lookup_cache()
+    if cache:
+        records += cache.items()
+    if os.path.isdir(RECORDED_RESPONSES_DIR):
+        records += read_recorded_responses(RECORDED_RESPONSES_DIR)
+    if not records:
+        showInfo("AutoDefine: There are no cached or recorded dictionary responses to build an offline pack from yet.")
+        return
+
+    # release the old pack's memory map before the file underneath it is replaced
+    if _offline_pack:
+        _offline_pack.close()
+        _offline_pack = None
+    _offline_pack_failed = False
+    if os.path.exists(OFFLINE_PACK_PATH):
+        # keep words from a pack that was copied over from another computer, unless it's damaged
+        try:
+            old_pack = OfflinePack(OFFLINE_PACK_PATH)
+        except (OSError, ValueError, struct.error):
+            old_pack = None
+        if old_pack:
+            records = list(old_pack.items()) + records
+            old_pack.close()
+    count = build_pack(OFFLINE_PACK_PATH, records)
+    showInfo("AutoDefine: Built an offline pack with %d words at:\n%s\n\n"
+             "Copy this file into the user_files folder of AutoDefine on other computers to use it there."
+             % (count, OFFLINE_PACK_PATH))
+
+
+def _format_invocation(invocation):
+    record = invocation.to_dict()
+    line = "%s  %-8s %-20s %8.1f ms" % (time.strftime("%H:%M:%S", time.localtime(record["started"])), record["kind"],
+                                        record["word"][:20], record["total_ms"] or 0)
+    line += "".join("  %s %.1f" % phase for phase in record["phases_ms"].items())
+    line += "".join("  %s=%d" % counter for counter in record["counters"].items())
+    return line
+
+
+def show_timings():
+    dialog = QDialog(mw)
+    dialog.setWindowTitle("AutoDefine Timings")
+    dialog.resize(900, 500)
+    layout = QVBoxLayout(dialog)
+
+    records = _invocation_log.records()
+    lines = ["Add-on loaded in %.1f ms at startup" % (startup_seconds * 1000)] if startup_seconds is not None else []
+    lines += ["%s: %s" % (source.name, _source_registry.stats[source.name].summary())
+              for source in _source_registry.ordered()]
+    lines.append("Dictionary requests: %s" % _in_flight_lookups.summary())
+    lines += [_format_invocation(invocation) for invocation in reversed(records)] or ["No AutoDefine lookups yet."]
+    text = QPlainTextEdit(dialog)
+    text.setReadOnly(True)
+    text.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+    text.setPlainText("\n".join(lines))
+    layout.addWidget(text)
+
+    def export():
+        path = QFileDialog.getSaveFileName(dialog, "Export AutoDefine Timings", "autodefine_timings.jsonl",
+                                           "JSON lines (*.jsonl)")[0]
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(_invocation_log.to_json_lines())
+            tooltip("AutoDefine: Exported %d timings." % len(records))
+
+    buttons = QHBoxLayout()
+    export_button = QPushButton("Export as JSON Lines...", dialog)
+    export_button.clicked.connect(export)
+    close_button = QPushButton("Close", dialog)
+    close_button.clicked.connect(dialog.accept)
+    buttons.addWidget(export_button)
+    buttons.addStretch()
+    buttons.addWidget(close_button)
+    layout.addLayout(buttons)
+    dialog.exec()
+
+
+def setup_tools_menu():
+    action = QAction("AutoDefine API Usage", mw)
+    action.triggered.connect(show_api_usage)
+    mw.form.menuTools.addAction(action)
+    action = QAction("AutoDefine Timings", mw)
+    action.triggered.connect(show_timings)
+    mw.form.menuTools.addAction(action)
+    action = QAction("Build AutoDefine Offline Pack", mw)
+    action.triggered.connect(build_offline_pack)
+    mw.form.menuTools.addAction(action)
+    action = QAction("Import Word List with AutoDefine...", mw)
+    action.triggered.connect(import_word_list)
+    mw.form.menuTools.addAction(action)
+
+
+def setup_browser_menu(browser):
+    action = QAction("AutoDefine Selected Notes", browser)
+    action.triggered.connect(lambda: define_selected_notes(browser))
+    browser.form.menuEdit.addSeparator()
+    browser.form.menuEdit.addAction(action)
+
+
+# Settings from the add-on configuration, by the section of config.json they're in. The shortcut keys are numbered to
+# keep them in order in Anki's config editor, e.g. "1 PRIMARY_SHORTCUT".
+EXTRA_SETTINGS = ("DEDICATED_INDIVIDUAL_BUTTONS", "DEFINITION_FIELD", "IGNORE_ARCHAIC",
+                  "MERRIAM_WEBSTER_MEDICAL_API_KEY", "OPEN_IMAGES_IN_BROWSER", "PREFERRED_DICTIONARY",
+                  "PRONUNCIATION_FIELD", "PHONETIC_TRANSCRIPTION_FIELD", "CACHE_TTL_DAYS", "CACHE_MAX_ENTRIES",
+                  "NEGATIVE_CACHE_TTL_DAYS", "FETCH_MODE", "API_BACKEND", "REQUEST_TIMEOUT_SECONDS", "BULK_WORKERS",
+                  "DAILY_API_LIMIT", "MAX_REQUESTS_PER_SECOND", "AUDIO_CACHE_MB", "SPLIT_SELECTION",
+                  "PREFETCH_WHILE_TYPING")
+SHORTCUT_SETTINGS = ("PRIMARY_SHORTCUT", "DEFINE_ONLY_SHORTCUT", "PRONOUNCE_ONLY_SHORTCUT",
+                     "PHONETIC_TRANSCRIPTION_ONLY_SHORTCUT")
+
+_config_loaded = False
+
+
+def load_config():
+    # The configuration is read the first time something needs it rather than while Anki starts up, i.e. when the
+    # first editor opens or one of AutoDefine's menu entries is used.
+    global _config_loaded, MERRIAM_WEBSTER_API_KEY
+    if _config_loaded or not getattr(mw.addonManager, "getConfig", None):
+        return
+    _config_loaded = True
     config = mw.addonManager.getConfig(__name__)
     if '1 required' in config and 'MERRIAM_WEBSTER_API_KEY' in config['1 required']:
         MERRIAM_WEBSTER_API_KEY = config['1 required']['MERRIAM_WEBSTER_API_KEY']
@@ -491,32 +1542,22 @@ if getattr(mw.addonManager, "getConfig", None):
         showInfo("AutoDefine: The schema of the configuration has changed in a backwards-incompatible way.\n"
                  "Please remove and re-download the AutoDefine Add-on.")
 
-    if '2 extra' in config:
-        extra = config['2 extra']
-        if 'DEDICATED_INDIVIDUAL_BUTTONS' in extra:
-            DEDICATED_INDIVIDUAL_BUTTONS = extra['DEDICATED_INDIVIDUAL_BUTTONS']
-        if 'DEFINITION_FIELD' in extra:
-            DEFINITION_FIELD = extra['DEFINITION_FIELD']
-        if 'IGNORE_ARCHAIC' in extra:
-            IGNORE_ARCHAIC = extra['IGNORE_ARCHAIC']
-        if 'MERRIAM_WEBSTER_MEDICAL_API_KEY' in extra:
-            MERRIAM_WEBSTER_MEDICAL_API_KEY = extra['MERRIAM_WEBSTER_MEDICAL_API_KEY']
-        if 'OPEN_IMAGES_IN_BROWSER' in extra:
-            OPEN_IMAGES_IN_BROWSER = extra['OPEN_IMAGES_IN_BROWSER']
-        if 'PREFERRED_DICTIONARY' in extra:
-            PREFERRED_DICTIONARY = extra['PREFERRED_DICTIONARY']
-        if 'PRONUNCIATION_FIELD' in extra:
-            PRONUNCIATION_FIELD = extra['PRONUNCIATION_FIELD']
-        if 'PHONETIC_TRANSCRIPTION_FIELD' in extra:
-            PHONETIC_TRANSCRIPTION_FIELD = extra['PHONETIC_TRANSCRIPTION_FIELD']
-
-    if '3 shortcuts' in config:
-        shortcuts = config['3 shortcuts']
-        if '1 PRIMARY_SHORTCUT' in shortcuts:
-            PRIMARY_SHORTCUT = shortcuts['1 PRIMARY_SHORTCUT']
-        if '2 DEFINE_ONLY_SHORTCUT' in shortcuts:
-            DEFINE_ONLY_SHORTCUT = shortcuts['2 DEFINE_ONLY_SHORTCUT']
-        if '3 PRONOUNCE_ONLY_SHORTCUT' in shortcuts:
-            PRONOUNCE_ONLY_SHORTCUT = shortcuts['3 PRONOUNCE_ONLY_SHORTCUT']
-        if '4 PHONETIC_TRANSCRIPTION_ONLY_SHORTCUT' in shortcuts:
-            PHONETIC_TRANSCRIPTION_ONLY_SHORTCUT = shortcuts['4 PHONETIC_TRANSCRIPTION_ONLY_SHORTCUT']
+    settings = globals()
+    for name, value in config.get('2 extra', {}).items():
+        if name in EXTRA_SETTINGS:
+            settings[name] = value
+    for key, value in config.get('3 shortcuts', {}).items():
+        name = key.split(" ", 1)[-1]
+        if name in SHORTCUT_SETTINGS:
+            settings[name] = value
+
+
+addHook("setupEditorButtons", setup_buttons)
+addHook("browser.setupMenus", setup_browser_menu)
+addHook("editTimer", on_edit_timer)
+addHook("newModel", _clear_field_layouts)
+addHook("AddCards.noteAdded", _index_note)
+addHook("editFocusLost", _on_focus_lost)
+addHook("remNotes", _forget_notes)
+addHook("unloadProfile", _clear_collection_index)
+setup_tools_menu()
@@ -0,0 +1,134 @@
+# Persistent on-disk cache of raw Merriam-Webster API responses.
+#
+# Responses are stored in a single SQLite file inside the add-on's user_files folder (which Anki preserves across
+# add-on updates), keyed by dictionary (COLLEGIATE / MEDICAL) and normalized word. Entries older than the TTL are
+# treated as misses, and the least recently used rows are evicted once the table grows past its size cap.
+#
+# Words the dictionary has no entry for are remembered in a separate table, together with the ids of the entries it
+# offered instead, so asking again for a misspelling doesn't cost another API call. Since the dictionaries do add
+# words, these rows expire sooner than regular responses.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .words import normalize_word
+
+
+class LookupCache:
+    def __init__(self, path, ttl_seconds, max_entries, miss_ttl_seconds=0):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.miss_ttl_seconds = miss_ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS lookups ("
+                         "dictionary TEXT NOT NULL, "
+                         "word TEXT NOT NULL, "
+                         "body BLOB NOT NULL, "
+                         "fetched_at REAL NOT NULL, "
+                         "last_used REAL NOT NULL, "
+                         "PRIMARY KEY (dictionary, word))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS lookups_last_used ON lookups (last_used)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS misses ("
+                         "dictionary TEXT NOT NULL, "
+                         "word TEXT NOT NULL, "
+                         "suggestions TEXT NOT NULL, "
+                         "fetched_at REAL NOT NULL, "
+                         "PRIMARY KEY (dictionary, word))")
+
+    def get(self, dictionary, word):
+        key = (dictionary, normalize_word(word))
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT body, fetched_at FROM lookups WHERE dictionary = ? AND word = ?",
+                                   key).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE lookups SET last_used = ? WHERE dictionary = ? AND word = ?", (now,) + key)
+            self.hits += 1
+            return row[0]
+
+    def get_miss(self, dictionary, word):
+        # the suggested entry ids if the dictionary recently had no entry for the word, otherwise None
+        with self._lock:
+            row = self._db.execute("SELECT suggestions, fetched_at FROM misses WHERE dictionary = ? AND word = ?",
+                                   (dictionary, normalize_word(word))).fetchone()
+        if row is None or time.time() - row[1] > self.miss_ttl_seconds:
+            return None
+        return json.loads(row[0])
+
+    def contains(self, dictionary, word):
+        # whether looking the word up would be answered from the cache (a remembered miss included), without
+        # touching the hit/miss counters or the LRU order
+        key = (dictionary, normalize_word(word))
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT fetched_at FROM lookups WHERE dictionary = ? AND word = ?", key).fetchone()
+            if row is not None and now - row[0] <= self.ttl_seconds:
+                return True
+            row = self._db.execute("SELECT fetched_at FROM misses WHERE dictionary = ? AND word = ?", key).fetchone()
+        return row is not None and now - row[0] <= self.miss_ttl_seconds
+
+    def put(self, dictionary, word, body):
+        now = time.time()
+        key = (dictionary, normalize_word(word))
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)", key + (body, now, now))
+            self._db.execute("DELETE FROM misses WHERE dictionary = ? AND word = ?", key)
+            self._evict()
+
+    def put_miss(self, dictionary, word, suggestions):
+        if self.miss_ttl_seconds <= 0:
+            return
+        now = time.time()
+        key = (dictionary, normalize_word(word))
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO misses VALUES (?, ?, ?, ?)",
+                             key + (json.dumps(list(suggestions)), now))
+            self._db.execute("DELETE FROM lookups WHERE dictionary = ? AND word = ?", key)
+            self._evict()
+
+    def _evict(self):
+        # drop expired rows first, then the least recently used ones above the size cap
+        self._db.execute("DELETE FROM lookups WHERE fetched_at < ?", (time.time() - self.ttl_seconds,))
+        count = self._db.execute("SELECT COUNT(*) FROM lookups").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute("DELETE FROM lookups WHERE rowid IN "
+                             "(SELECT rowid FROM lookups ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+        self._db.execute("DELETE FROM misses WHERE fetched_at < ?", (time.time() - self.miss_ttl_seconds,))
+        count = self._db.execute("SELECT COUNT(*) FROM misses").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute("DELETE FROM misses WHERE rowid IN "
+                             "(SELECT rowid FROM misses ORDER BY fetched_at LIMIT ?)", (count - self.max_entries,))
+
+    def items(self):
+        # every unexpired response as (dictionary, word, body), e.g. for building an offline pack
+        with self._lock:
+            rows = self._db.execute("SELECT dictionary, word, body FROM lookups WHERE fetched_at >= ?",
+                                    (time.time() - self.ttl_seconds,)).fetchall()
+        return rows
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM lookups")
+            self._db.execute("DELETE FROM misses")
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM lookups").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
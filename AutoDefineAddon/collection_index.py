@@ -0,0 +1,67 @@
+# Index of the definitions already in the collection, by the word in the first field of their note.
+#
+# Collections often hold a note for the same word in more than one deck. Rather than asking the dictionary again, the
+# fields AutoDefine fills (pronunciation, definition, phonetic transcription) are copied over from another note for the
+# word: the most recently modified one that has every field being filled. The index is filled from the collection's
+# notes table a chunk at a time while Anki is idle, and kept current as notes are added, edited and deleted; it's only
+# used once it's complete.
+
+import threading
+from collections import namedtuple
+
+from .words import normalize_word
+
+KnownNote = namedtuple("KnownNote", ["note_id", "pronunciation", "definition", "phonetic_transcription", "modified"])
+
+
+class CollectionIndex:
+    def __init__(self):
+        # set once every note in the collection has been read
+        self.ready = False
+        # word -> {note id: KnownNote}
+        self._notes = {}
+        # note id -> the word it's indexed under, so a note whose first field changes doesn't linger under the old one
+        self._words = {}
+        self._lock = threading.Lock()
+
+    def add(self, note_id, word, pronunciation, definition, phonetic_transcription, modified):
+        # modified is when the note was last changed, in seconds; an older version of a note never replaces a newer one
+        word = normalize_word(word)
+        with self._lock:
+            old_word = self._words.get(note_id)
+            if old_word is not None:
+                known = self._notes[old_word][note_id]
+                if known.modified > modified:
+                    return
+                self._remove(note_id)
+            if word and (pronunciation or definition or phonetic_transcription):
+                self._notes.setdefault(word, {})[note_id] = KnownNote(note_id, pronunciation, definition,
+                                                                      phonetic_transcription, modified)
+                self._words[note_id] = word
+
+    def remove(self, note_ids):
+        with self._lock:
+            for note_id in note_ids:
+                self._remove(note_id)
+
+    def _remove(self, note_id):
+        word = self._words.pop(note_id, None)
+        if word is None:
+            return
+        candidates = self._notes[word]
+        del candidates[note_id]
+        if not candidates:
+            del self._notes[word]
+
+    def get(self, word, fields, exclude_note_id=None):
+        # the most recently modified note for word that has all the given fields (KnownNote field names), other than
+        # the note being defined
+        with self._lock:
+            candidates = list(self._notes.get(normalize_word(word), {}).values())
+        candidates = [known for known in candidates
+                      if known.note_id != exclude_note_id and all(getattr(known, field) for field in fields)]
+        return max(candidates, key=lambda known: known.modified, default=None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._notes)
@@ -0,0 +1,98 @@
+# Lightweight per-phase timing of AutoDefine invocations.
+#
+# Each press of the button (or note in a batch job) gets an Invocation that collects wall time per phase (network,
+# parse, render, insert, ...) and counters such as bytes downloaded and cache hits. The invocation lives in a context
+# variable, so code deep in the lookup path can record into it without passing it around; work handed to an executor
+# is wrapped with in_current_context to carry it along. Finished invocations go into a fixed-size ring buffer.
+
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+
+_current = contextvars.ContextVar("autodefine_invocation", default=None)
+
+
+class Invocation:
+    def __init__(self, kind, word):
+        self.kind = kind
+        self.word = word
+        self.started = time.time()
+        self.total = None
+        self.phases = {}
+        self.counters = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def finish(self):
+        self.total = time.perf_counter() - self._start
+
+    def to_dict(self):
+        with self._lock:
+            return {"kind": self.kind,
+                    "word": self.word,
+                    "started": self.started,
+                    "total_ms": round(self.total * 1000, 3) if self.total is not None else None,
+                    "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+                    "counters": dict(self.counters)}
+
+
+class InvocationLog:
+    def __init__(self, capacity):
+        self._records = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def add(self, invocation):
+        with self._lock:
+            self._records.append(invocation)
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def to_json_lines(self):
+        return "".join(json.dumps(invocation.to_dict(), ensure_ascii=False) + "\n" for invocation in self.records())
+
+
+@contextlib.contextmanager
+def activate(invocation):
+    token = _current.set(invocation)
+    try:
+        yield invocation
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def phase(name):
+    invocation = _current.get()
+    if invocation is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        invocation.add_time(name, time.perf_counter() - start)
+
+
+def count(name, amount=1):
+    invocation = _current.get()
+    if invocation is not None:
+        invocation.count(name, amount)
+
+
+def in_current_context(func):
+    # every call needs its own copy, since one context can't be entered by two threads at once
+    return functools.partial(contextvars.copy_context().run, func)
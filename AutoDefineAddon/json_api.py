@@ -0,0 +1,185 @@
+# Decoding of responses from Merriam-Webster's JSON API (v3).
+#
+# The JSON responses are smaller than the legacy XML ones and json.loads is much faster than building an ElementTree.
+# To keep a single way of rendering entries, the entries matching the looked-up word are turned into the same elements
+# the XML API returns (<entry> with <hw>, <sound>/<wav>, <pr>, <fl>, <in> and <def>), with the markup in the defining
+# text ({bc}, {sx|...}, {dx}...) translated to its XML counterpart. Entries that don't match are reduced to their id,
+# just like parse_entries does, and a list of suggested spellings becomes such id-only entries as well.
+#
+# https://dictionaryapi.com/products/json
+
+import json
+import re
+from xml.etree import ElementTree as ET
+
+from .parsing import InvalidApiKey, entry_id_matches
+
+COLLEGIATE_URL = "https://www.dictionaryapi.com/api/v3/references/collegiate/json/"
+MEDICAL_URL = "https://www.dictionaryapi.com/api/v3/references/medical/json/"
+
+_TOKEN = re.compile(r"{([^{}]*)}")
+
+# paired tokens that become an element of the same name, e.g. {it}...{/it} to <it>...</it>
+_PAIRED_TOKENS = {"b", "bit", "dx", "dx_def", "dx_ety", "gloss", "inf", "it", "parahw", "phrase", "qword", "sc", "sup",
+                  "wi"}
+
+# tokens standing for a piece of text
+_TEXT_TOKENS = {"bc": ":", "ldquo": "“", "rdquo": "”", "p_br": " "}
+
+# links whose first field is the text to show
+_LINK_TOKENS = {"a_link", "d_link", "et_link", "i_link", "mat"}
+
+
+def is_json_response(body):
+    return body.lstrip()[:1] in (b"[", b"{")
+
+
+def parse_json_entries(body, word, dictionary):
+    if b"Invalid API key" in body:
+        raise InvalidApiKey()
+
+    entries = []
+    found_exact = False
+    for item in json.loads(body):
+        if isinstance(item, str):
+            # no entry for the word, just suggestions for what might have been meant
+            entries.append(ET.Element("entry", id=item))
+            continue
+
+        entry_id = _entry_id(item)
+        if entry_id_matches(word, entry_id):
+            found_exact = True
+            entries.append(_decode_entry(item, entry_id, dictionary))
+        elif entry_id_matches(word, entry_id, lower=True):
+            entries.append(_decode_entry(item, entry_id, dictionary))
+        elif found_exact:
+            break
+        else:
+            entries.append(ET.Element("entry", id=entry_id))
+    return entries
+
+
+def _entry_id(item):
+    # homographs are "set:1", "set:2" here, but "set[1]", "set[2]" in the XML API
+    return re.sub(r":(\d+)$", r"[\1]", item.get("meta", {}).get("id", ""))
+
+
+def _decode_entry(item, entry_id, dictionary):
+    entry = ET.Element("entry", id=entry_id)
+    headword = item.get("hwi", {})
+    ET.SubElement(entry, "hw").text = headword.get("hw", "")
+
+    pronunciations = headword.get("prs", [])
+    wavs = [pronunciation["sound"]["audio"] + ".wav" for pronunciation in pronunciations
+            if pronunciation.get("sound", {}).get("audio")]
+    if wavs:
+        sound = ET.SubElement(entry, "sound")
+        for wav in dict.fromkeys(wavs):
+            ET.SubElement(sound, "wav").text = wav
+    written = [pronunciation["mw"] for pronunciation in pronunciations if pronunciation.get("mw")]
+    if written:
+        ET.SubElement(entry, "pr").text = ", ".join(written)
+
+    if "fl" in item:
+        ET.SubElement(entry, "fl").text = item["fl"]
+
+    if item.get("ins"):
+        inflections = ET.SubElement(entry, "in")
+        for inflection in item["ins"]:
+            if inflection.get("il"):
+                ET.SubElement(inflections, "il").text = inflection["il"]
+            if inflection.get("if"):
+                ET.SubElement(inflections, "if").text = inflection["if"]
+
+    for definition_section in item.get("def", []):
+        definition = ET.SubElement(entry, "def")
+        for sequence in definition_section.get("sseq", []):
+            # the medical XML API puts each sense in <sensb><sens>, the collegiate one lists them right in <def>
+            parent = definition
+            if dictionary == "MEDICAL":
+                parent = ET.SubElement(definition, "sensb")
+            for sense in _senses(sequence):
+                if dictionary == "MEDICAL":
+                    _decode_sense(sense, ET.SubElement(parent, "sens"))
+                else:
+                    _decode_sense(sense, parent)
+    return entry
+
+
+def _senses(sequence):
+    for kind, data in sequence:
+        if kind == "sense":
+            yield data
+        elif kind == "bs" and "sense" in data:
+            yield data["sense"]
+        elif kind == "pseq":
+            yield from _senses(data)
+
+
+def _decode_sense(sense, parent):
+    if "obsolete" in sense.get("sls", []):
+        ET.SubElement(parent, "ssl").text = "obsolete"
+    if sense.get("sn"):
+        ET.SubElement(parent, "sn").text = sense["sn"]
+    if "dt" in sense:
+        _decode_defining_text(sense["dt"], ET.SubElement(parent, "dt"))
+    divided = sense.get("sdsense")
+    if divided and "dt" in divided:
+        ET.SubElement(parent, "sd").text = divided.get("sd", "")
+        _decode_defining_text(divided["dt"], ET.SubElement(parent, "dt"))
+
+
+def _decode_defining_text(items, dt):
+    for kind, data in items:
+        if kind == "text":
+            _append_markup(dt, data)
+        elif kind == "vis":
+            for illustration in data:
+                _append_markup(ET.SubElement(dt, "vi"), illustration.get("t", ""))
+        elif kind == "uns":
+            for note in data:
+                _decode_defining_text(note, ET.SubElement(dt, "un"))
+        # anything else (run-in entries, supplemental notes, ...) isn't rendered from the XML either
+
+
+def _append_markup(parent, markup):
+    # turns text with {tokens} into text and child elements of parent
+    if "{" not in markup:
+        _append_text(parent, markup)
+        return
+    stack = [parent]
+    # split() alternates between the text around tokens and the tokens' contents
+    pieces = _TOKEN.split(markup)
+    for index in range(0, len(pieces), 2):
+        _append_text(stack[-1], pieces[index])
+        if index + 1 == len(pieces):
+            break
+
+        fields = pieces[index + 1].split("|")
+        token = fields[0]
+        if token in _TEXT_TOKENS:
+            _append_text(stack[-1], _TEXT_TOKENS[token])
+        elif token in _PAIRED_TOKENS:
+            stack.append(ET.SubElement(stack[-1], token))
+        elif token[:1] == "/" and token[1:] in _PAIRED_TOKENS:
+            if len(stack) > 1:
+                stack.pop()
+        elif token == "sx":
+            ET.SubElement(stack[-1], "sx").text = fields[1]
+        elif token == "dxt":
+            target = ET.SubElement(stack[-1], "dxt")
+            target.text = fields[1]
+            if len(fields) > 3 and fields[3] and fields[3] not in ("illustration", "table"):
+                ET.SubElement(target, "dxn").text = fields[3]
+        elif token in _LINK_TOKENS:
+            _append_text(stack[-1], fields[1])
+
+
+def _append_text(parent, text):
+    if not text:
+        return
+    if len(parent):
+        last = parent[-1]
+        last.tail = (last.tail or "") + text
+    else:
+        parent.text = (parent.text or "") + text
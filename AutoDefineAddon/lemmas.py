@@ -0,0 +1,102 @@
+# Maps inflected forms ("running", "geese", "obstinacies") to the headword the dictionary lists them under, so a form
+# without an entry of its own still gets defined.
+#
+# A word is always looked up as typed first, since forms like "saw", "left" or "found" are headwords of their own as
+# well; only once that has no entry is the headword tried. Most of the knowledge comes from the dictionary itself: every
+# entry lists its irregular and notable inflections in <in>/<if>, and these are collected from every entry AutoDefine
+# has seen (cached responses, offline pack, new lookups) for resolve(). For forms not listed there, guess() offers a
+# base form from a small table of irregular forms that aren't headwords of their own (unlike e.g. "stole", "thought"
+# or "frozen"), or one produced by a few English suffix rules, if it's a headword we already know. Since both only come
+# after a miss, a word with an entry of its own like "news" or "being" is never looked up as "new" or "be".
+
+import re
+import threading
+
+IRREGULAR_FORMS = {
+    "geese": "goose", "mice": "mouse", "lice": "louse", "children": "child", "teeth": "tooth", "feet": "foot",
+    "oxen": "ox", "women": "woman", "men": "man", "went": "go", "ran": "run", "swam": "swim", "swum": "swim",
+    "began": "begin", "begun": "begin", "drank": "drink", "wrote": "write", "ate": "eat", "eaten": "eat",
+    "took": "take", "taken": "take", "gave": "give", "chose": "choose", "flew": "fly", "flown": "fly",
+    "knew": "know", "threw": "throw", "thrown": "throw", "grew": "grow", "drew": "draw", "sang": "sing",
+    "sung": "sing", "rang": "ring", "sank": "sink", "brought": "bring", "bought": "buy", "caught": "catch",
+    "taught": "teach", "sought": "seek", "fought": "fight", "was": "be", "were": "be", "been": "be", "is": "be",
+    "did": "do", "has": "have", "had": "have", "told": "tell", "became": "become", "forgot": "forget",
+    "forgotten": "forget", "froze": "freeze",
+}
+
+# (suffix, replacement) pairs, tried in this order. The ones keeping or restoring a silent "e" come first, so "hoping"
+# and "hopes" are "hope" rather than "hop" (which "hopping" still gets to through the doubled consonant).
+SUFFIX_RULES = [
+    ("ies", "y"), ("ied", "y"), ("ier", "y"), ("iest", "y"), ("ying", "ie"), ("ves", "f"), ("ves", "fe"),
+    ("ing", "e"), ("ing", ""), ("ed", "e"), ("ed", ""), ("s", ""), ("es", ""), ("er", "e"), ("er", ""),
+    ("est", "e"), ("est", ""),
+]
+
+_HOMOGRAPH_NUMBER = re.compile(r"\[\d+\]$")
+
+
+def _plain(form):
+    # "ob*sti*na*cies" -> "obstinacies"
+    return form.replace("*", "").strip().lower()
+
+
+def candidate_lemmas(word):
+    word = word.lower()
+    for suffix, replacement in SUFFIX_RULES:
+        if len(word) > len(suffix) + 1 and word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            yield stem + replacement
+            # "running" -> "runn" -> "run", "bigger" -> "bigg" -> "big"
+            if not replacement and suffix in ("ing", "ed", "er", "est") and len(stem) > 2 and stem[-1] == stem[-2]:
+                yield stem[:-1]
+
+
+class InflectionIndex:
+    def __init__(self):
+        self._headwords = set()
+        self._forms = {}
+        self._lock = threading.Lock()
+
+    def add_entries(self, entries):
+        # returns the headwords of the entries
+        headwords = []
+        with self._lock:
+            for entry in entries:
+                headword = _HOMOGRAPH_NUMBER.sub("", entry.get("id", "")).lower()
+                if not headword or entry.find("def") is None:
+                    continue
+                self._headwords.add(headword)
+                headwords.append(headword)
+                for inflection in entry.iterfind("in/if"):
+                    form = _plain(inflection.text or "")
+                    # abbreviated forms like "-nies" can't be told apart from other words
+                    if form and not form.startswith("-") and form != headword:
+                        self._forms.setdefault(form, headword)
+        return headwords
+
+    def headwords(self):
+        with self._lock:
+            return list(self._headwords)
+
+    def resolve(self, word):
+        # the headword the dictionary lists word as an inflection of, to look up once word itself had no entry, or None
+        word = word.lower()
+        with self._lock:
+            if word in self._headwords:
+                return None
+            return self._forms.get(word)
+
+    def guess(self, word):
+        # a likely base form to look up once word itself turned out to have no entry, or None
+        word = word.lower()
+        if word in IRREGULAR_FORMS:
+            return IRREGULAR_FORMS[word]
+        with self._lock:
+            for candidate in candidate_lemmas(word):
+                if candidate in self._headwords:
+                    return candidate
+        return None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._forms)
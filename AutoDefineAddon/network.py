@@ -0,0 +1,108 @@
+# Keep-alive HTTP(S) connection pool for talking to Merriam-Webster.
+#
+# urllib.request.urlopen opens a new TCP connection (and TLS session) for every call, which costs more than the
+# dictionary response itself when defining many words. This pool keeps idle connections per host around for reuse,
+# asks for gzip-compressed responses, and transparently reconnects when the server has closed an idle connection.
+
+import gzip
+import http.client
+import threading
+import urllib.parse
+import zlib
+from http.client import IncompleteRead, RemoteDisconnected
+from urllib.error import HTTPError, URLError
+
+MAX_REDIRECTS = 5
+
+
+class ConnectionPool:
+    def __init__(self, user_agent, max_idle_per_host=8):
+        self.user_agent = user_agent
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, timeout):
+        for _ in range(MAX_REDIRECTS):
+            status, headers, body = self._request(url, timeout)
+            if status in (301, 302, 303, 307, 308) and headers.get("Location"):
+                url = urllib.parse.urljoin(url, headers["Location"])
+                continue
+            if status >= 400:
+                raise HTTPError(url, status, http.client.responses.get(status, ""), headers, None)
+            return body
+        raise URLError("Too many redirects for %s" % url)
+
+    def _request(self, url, timeout):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = {"User-Agent": self.user_agent, "Accept-Encoding": "gzip", "Connection": "keep-alive"}
+
+        connection, reused = self._checkout(key, timeout)
+        try:
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # the server dropped a connection that sat idle in the pool; retry once on a fresh one
+                connection.close()
+                if not reused:
+                    raise
+                connection = self._connect(key, timeout)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            body = response.read()
+        except IncompleteRead as e:
+            # the connection broke off partway through the body; not an OSError, so callers wouldn't expect it
+            connection.close()
+            raise URLError("Incomplete response from %s: %s" % (parts.netloc, e))
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(key, connection)
+
+        if response.getheader("Content-Encoding", "").lower() == "gzip":
+            try:
+                body = gzip.decompress(body)
+            except (OSError, EOFError, zlib.error) as e:
+                # a truncated or corrupt body fails like a broken connection would, instead of as EOFError/zlib.error
+                raise URLError("Couldn't decompress the response from %s: %s" % (parts.netloc, e))
+        return response.status, response.headers, body
+
+    def _checkout(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+        if connection is None:
+            return self._connect(key, timeout), False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    @staticmethod
+    def _connect(key, timeout):
+        scheme, netloc = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=timeout)
+        return http.client.HTTPConnection(netloc, timeout=timeout)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
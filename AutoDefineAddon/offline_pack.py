@@ -0,0 +1,150 @@
+# Offline dictionary pack: a single file holding API responses for many words, for machines without internet access.
+#
+# Layout (all integers little-endian):
+#   header  8-byte magic, uint32 slot count, uint32 record count
+#   slots   open-addressing hash table; each slot is uint64 key hash, uint64 record offset, uint32 record length
+#           and 4 bytes of padding. A zero hash marks an empty slot.
+#   records uint16 key length, the UTF-8 key ("DICTIONARY:normalized word"), then the zlib-compressed response body
+#
+# The reader memory-maps the file, so opening a pack costs nothing up front and each lookup touches only the few
+# pages holding its slot and record.
+
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+from .words import normalize_word
+
+MAGIC = b"ADPACK1\0"
+HEADER = struct.Struct("<8sII")
+SLOT = struct.Struct("<QQI4x")
+KEY_LENGTH = struct.Struct("<H")
+
+
+def _pack_key(dictionary, word):
+    return ("%s:%s" % (dictionary, normalize_word(word))).encode("utf-8")
+
+
+def _hash_key(key):
+    # needs to be stable between runs, so Python's (randomized) hash() won't do; 0 is reserved for empty slots
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+def build_pack(path, records):
+    # records is an iterable of (dictionary, word, response body); later duplicates replace earlier ones
+    bodies = {}
+    for dictionary, word, body in records:
+        bodies[_pack_key(dictionary, word)] = body
+
+    slot_count = 1
+    while slot_count < 2 * len(bodies):
+        slot_count *= 2
+    slots = [(0, 0, 0)] * slot_count
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.seek(HEADER.size + slot_count * SLOT.size)
+        for key, body in sorted(bodies.items()):
+            record = KEY_LENGTH.pack(len(key)) + key + zlib.compress(body, 9)
+            key_hash = _hash_key(key)
+            index = key_hash & (slot_count - 1)
+            while slots[index][0] != 0:
+                index = (index + 1) & (slot_count - 1)
+            slots[index] = (key_hash, f.tell(), len(record))
+            f.write(record)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, slot_count, len(bodies)))
+        for slot in slots:
+            f.write(SLOT.pack(*slot))
+    os.replace(temp_path, path)
+    return len(bodies)
+
+
+def read_recorded_responses(directory):
+    # recorded API XML laid out as <directory>/<DICTIONARY>/<word>.xml
+    for dictionary in sorted(os.listdir(directory)):
+        dictionary_dir = os.path.join(directory, dictionary)
+        if not os.path.isdir(dictionary_dir):
+            continue
+        for filename in sorted(os.listdir(dictionary_dir)):
+            if filename.endswith(".xml"):
+                with open(os.path.join(dictionary_dir, filename), "rb") as f:
+                    yield dictionary, filename[:-len(".xml")], f.read()
+
+
+class OfflinePack:
+    def __init__(self, path):
+        self.path = path
+        # an empty file can't be mapped, and a truncated one has no room for its header (struct.error)
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self._file.close()
+            raise
+        try:
+            magic, self.slot_count, self.record_count = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC:
+                raise ValueError("%s is not an AutoDefine offline pack" % path)
+            # the slot mask only works for a power of two, and every slot has to be inside the file
+            if self.slot_count == 0 or self.slot_count & (self.slot_count - 1) \
+                    or HEADER.size + self.slot_count * SLOT.size > len(self._map):
+                raise ValueError("%s is truncated or corrupt" % path)
+        except (ValueError, struct.error):
+            self.close()
+            raise
+
+    def get(self, dictionary, word):
+        # a record that's damaged (e.g. in a pack whose copy didn't finish) counts as a miss
+        key = _pack_key(dictionary, word)
+        key_hash = _hash_key(key)
+        mask = self.slot_count - 1
+        index = key_hash & mask
+        for _ in range(self.slot_count):
+            slot_hash, offset, length = SLOT.unpack_from(self._map, HEADER.size + index * SLOT.size)
+            if slot_hash == 0:
+                return None
+            if slot_hash == key_hash:
+                record = self._read_record(offset, length)
+                if record and record[0] == key:
+                    return record[1]
+            index = (index + 1) & mask
+        return None
+
+    def items(self):
+        # damaged records are skipped
+        for index in range(self.slot_count):
+            slot_hash, offset, length = SLOT.unpack_from(self._map, HEADER.size + index * SLOT.size)
+            if slot_hash == 0:
+                continue
+            record = self._read_record(offset, length)
+            if record is None:
+                continue
+            try:
+                dictionary, word = record[0].decode("utf-8").split(":", 1)
+            except (UnicodeDecodeError, ValueError):
+                continue
+            yield dictionary, word, record[1]
+
+    def _read_record(self, offset, length):
+        # the key and decompressed body of the record, or None if it's outside the file or doesn't decompress
+        if offset + length > len(self._map):
+            return None
+        try:
+            key_length = KEY_LENGTH.unpack_from(self._map, offset)[0]
+            key_start = offset + KEY_LENGTH.size
+            if key_start + key_length > offset + length:
+                return None
+            return bytes(self._map[key_start:key_start + key_length]), \
+                zlib.decompress(self._map[key_start + key_length:offset + length])
+        except (struct.error, zlib.error):
+            return None
+
+    def __len__(self):
+        return self.record_count
+
+    def close(self):
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,80 @@
+# Incremental parsing of Merriam-Webster XML responses.
+#
+# Only entries whose id matches the looked-up word are ever rendered, but responses for common words ("set", "run")
+# also carry dozens of compounds and run-ons. Instead of building the whole tree, the response is fed to a pull parser
+# in chunks: matching entries are kept whole, other entries are emptied as soon as they have been read (their id is
+# still needed for "Potential matches"), and parsing stops once the matching entries are behind us.
+
+import re
+from collections import namedtuple
+from xml.etree import ElementTree as ET
+
+CHUNK_SIZE = 16 * 1024
+
+
+class InvalidApiKey(Exception):
+    pass
+
+
+ValidAndPotentialEntries = namedtuple('Entries', ['valid', 'potential'])
+
+
+def entry_id_matches(word, entry_id, lower=False):
+    # ids look like "word" or "word[2]" for the second homograph
+    if lower:
+        word = word.lower()
+        entry_id = entry_id.lower()
+    return entry_id == word or entry_id[:len(word) + 1] == word + "["
+
+
+def parse_entries(body, word):
+    # the markers are searched for in the raw bytes, so the body never has to be decoded
+    if b"Invalid API key" in body:
+        raise InvalidApiKey()
+    if b"Results not found" in body:
+        return []
+
+    parser = ET.XMLPullParser(events=("start", "end"))
+    entries = []
+    depth = 0
+    found_exact = False
+    for chunk_start in range(0, len(body), CHUNK_SIZE):
+        parser.feed(body[chunk_start:chunk_start + CHUNK_SIZE])
+        for event, element in parser.read_events():
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1 or element.tag != "entry":
+                continue
+
+            entry_id = element.get("id", "")
+            if entry_id_matches(word, entry_id):
+                found_exact = True
+                entries.append(element)
+            elif entry_id_matches(word, entry_id, lower=True):
+                entries.append(element)
+            elif found_exact:
+                # homographs are listed together, so the first non-matching entry after them means we're done
+                return entries
+            else:
+                element.clear()
+                element.set("id", entry_id)
+                entries.append(element)
+    parser.close()
+    return entries
+
+
+def filter_entries_lower_and_potential(word, all_entries):
+    valid_entries = extract_valid_entries(word, all_entries)
+    maybe_entries = set()
+    if not valid_entries:
+        valid_entries = extract_valid_entries(word, all_entries, True)
+        if not valid_entries:
+            for entry in all_entries:
+                maybe_entries.add(re.sub(r'\[\d+\]$', "", entry.attrib["id"]))
+    return ValidAndPotentialEntries(valid_entries, maybe_entries)
+
+
+def extract_valid_entries(word, all_entries, lower=False):
+    return [entry for entry in all_entries if entry_id_matches(word, entry.attrib["id"], lower)]
@@ -0,0 +1,77 @@
+# Pacing and daily budget accounting for Merriam-Webster API keys.
+#
+# Free dictionaryapi.com keys are limited to 1000 calls per day. Each key gets a token bucket that spaces requests out
+# to a steady rate, plus a usage counter that is persisted to the add-on's user_files folder and starts over every
+# (local) day, so that batch jobs can check how much of the budget is left before they start.
+
+import json
+import os
+import threading
+import time
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _today():
+    return time.strftime("%Y-%m-%d")
+
+
+class ApiQuota:
+    def __init__(self, path, daily_limit, requests_per_second):
+        self.path = path
+        self.daily_limit = daily_limit
+        self.requests_per_second = requests_per_second
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._usage = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._usage = json.load(f)
+            except (OSError, ValueError):
+                self._usage = {}
+
+    def used(self, api_key):
+        with self._lock:
+            return self._used_today(api_key)
+
+    def remaining(self, api_key):
+        return max(0, self.daily_limit - self.used(api_key))
+
+    def acquire(self, api_key):
+        # counts one call against today's budget and blocks until the key's token bucket allows it to go out
+        with self._lock:
+            used = self._used_today(api_key)
+            if used >= self.daily_limit:
+                raise QuotaExceeded()
+            self._usage[api_key] = {"day": _today(), "used": used + 1}
+            self._save()
+            wait = self._take_token(api_key)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _used_today(self, api_key):
+        usage = self._usage.get(api_key)
+        if not usage or usage["day"] != _today():
+            return 0
+        return usage["used"]
+
+    def _take_token(self, api_key):
+        if self.requests_per_second <= 0:
+            return 0
+        burst = max(1.0, self.requests_per_second)
+        now = time.monotonic()
+        tokens, last = self._buckets.get(api_key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * self.requests_per_second) - 1
+        self._buckets[api_key] = (tokens, now)
+        # a negative balance is a reservation: the caller sleeps until its token would have been refilled
+        return -tokens / self.requests_per_second if tokens < 0 else 0
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self._usage, f)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,131 @@
+# Turns Merriam-Webster entries into what goes into the note's fields: pronunciation URLs, phonetic transcriptions and
+# definitions.
+#
+# Definitions are rendered from the <dt> (defining text) elements. This walks each <dt> subtree once and writes text
+# straight into a list of output pieces, leaving the parsed entries untouched so the same entry can be rendered any
+# number of times. The output is identical to what serializing each <dt> with ET.tostring and then stripping its tags
+# used to produce: text is escaped the way the serializer escaped it (&, < and >, plus character references for
+# anything outside ASCII), colons are dropped, and <sx>/<dx> cross references
+# become semicolons.
+
+# children to leave out, keyed by the tags leading to them from the <dt>: we don't really care for 'verbal
+# illustrations' or 'usage notes', and the directional cross reference number doesn't make sense for us
+_OMITTED_CHILDREN = {(): ("un", "vi"), ("dx", "dxt"): ("dxn",)}
+
+_ASCII_WHITESPACE = " \t\n\r\x0b\x0c"
+
+_ESCAPES = str.maketrans({":": None, "&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+
+def sound_urls(entries):
+    # Parse all unique pronunciations, and convert them to URLs as per http://goo.gl/nL0vte
+    all_sounds = []
+    for entry in entries:
+        for wav in entry.findall("sound/wav"):
+            raw_wav = wav.text
+            # API-specific URL conversions
+            if raw_wav[:3] == "bix":
+                mid_url = "bix"
+            elif raw_wav[:2] == "gg":
+                mid_url = "gg"
+            elif raw_wav[:1].isdigit():
+                mid_url = "number"
+            else:
+                mid_url = raw_wav[:1]
+            all_sounds.append("http://media.merriam-webster.com/soundc11/" + mid_url + "/" + raw_wav)
+
+    # We want to make this a non-duplicate list, so that we only get unique sound files.
+    return list(dict.fromkeys(all_sounds))
+
+
+def render_phonetic_transcriptions(entries, abbreviations):
+    # extract phonetic transcriptions for each entry and label them by part of speech
+    all_transcriptions = []
+    for entry in entries:
+        if entry.find("pr") is not None:
+            phonetic_transcription = entry.find("pr").text
+            part_of_speech = entry.find("fl").text
+            part_of_speech = abbreviations.get(part_of_speech, part_of_speech)
+            all_transcriptions.append(f'<b>{part_of_speech}</b> \\{phonetic_transcription}\\')
+    return "<br>".join(all_transcriptions)
+
+
+def _escape(text):
+    text = text.translate(_ESCAPES)
+    if not text.isascii():
+        text = text.encode("ascii", "xmlcharrefreplace").decode("ascii")
+    return text
+
+
+def _render_element(element, path, parts):
+    # 'synonymous' and 'directional' cross references become semicolons, but only where the serializer would have
+    # written a bare "<sx>" / "<dx>" opening tag (no attributes, not self-closing)
+    if element.tag in ("sx", "dx") and not element.attrib and (element.text or len(element)):
+        parts.append("; ")
+    if element.text:
+        parts.append(_escape(element.text))
+
+    omitted = _OMITTED_CHILDREN.get(path, ()) if path is not None else ()
+    for child in element:
+        if child.tag in omitted:
+            continue
+        child_path = path + (child.tag,) if path is not None and len(path) < 2 else None
+        _render_element(child, child_path, parts)
+        if child.tail:
+            parts.append(_escape(child.tail))
+
+
+def render_defining_text(dt, obsolete=False):
+    parts = []
+    _render_element(dt, (), parts)
+    # an obsolete <dt> used to have its tail overwritten, so only a regular one brings its tail along (minus the
+    # trailing whitespace that was stripped off the serialized XML before anything else happened to it)
+    if dt.tail and not obsolete:
+        parts.append(_escape(dt.tail.rstrip(_ASCII_WHITESPACE)))
+    # erase space between semicolon and previous word, if exists, and strip any extraneous whitespace
+    return "".join(parts).replace(" ; ", "; ").strip()
+
+
+def _defining_texts(definition):
+    # The <ssl> tag will contain the word 'obsolete' if the term is not in use anymore. However, for some reason, the
+    # tag precedes the <dt> that it is associated with instead of being a child.
+    previous_was_ssl = False
+    for child in definition:
+        if child.text == "obsolete" and child.tag == "ssl":
+            previous_was_ssl = True
+        if child.tag == "dt":
+            yield child, previous_was_ssl
+            previous_was_ssl = False
+
+    medical_api_def = definition.findall("./sensb/sens/dt")
+    # sometimes there's not a definition directly (dt) but just a usage example (un):
+    if len(medical_api_def) == 1 and not medical_api_def[0].text:
+        medical_api_def = definition.findall("./sensb/sens/dt/un")
+    for dt in medical_api_def:
+        yield dt, False
+
+
+def render_definitions(entries, ignore_archaic, abbreviations):
+    out = []
+    for entry in entries:
+        fl = entry.find("fl")
+        definition = entry.find("def")
+        if fl is None or definition is None:
+            continue
+        functional_label = "<b>" + abbreviations.get(fl.text, fl.text) + "</b>"
+
+        first = True
+        for dt, obsolete in _defining_texts(definition):
+            if obsolete and ignore_archaic:
+                continue
+            # add verb/noun/adjective in front of the entry's first definition
+            if first:
+                out.append(functional_label + " ")
+                first = False
+            out.append(render_defining_text(dt, obsolete))
+            out.append("\n<br>")
+
+    to_return = "".join(out)
+    # final cleanup of <sx> tag bs
+    to_return = to_return.replace(".</b> ; ", ".</b> ")  # <sx> as first definition after "n. " or "v. "
+    return to_return.replace("\n; ", "\n")  # <sx> as first definition after newline
@@ -0,0 +1,50 @@
+# Coalescing of identical lookups that are in flight at the same time.
+#
+# A double press of the shortcut, or the editor asking for a word a batch job is fetching at that moment, would
+# otherwise send the same request twice and pay for it twice in quota. The first caller for a key does the work; any
+# caller with the same key arriving before it's done waits for that result instead of starting its own. Nothing is
+# kept once the work is finished, since remembering results is the lookup cache's job.
+
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        # returns func's result and whether it came from another caller's call
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = Future()
+                self._in_flight[key] = future
+                self.calls += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            # raises whatever the first caller's call raised
+            return future.result(), True
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return result, False
+
+    def summary(self):
+        with self._lock:
+            return "%d lookups, %d of them shared with an identical lookup already in flight" \
+                   % (self.calls + self.shared, self.shared)
@@ -0,0 +1,123 @@
+# Registry of the dictionaries AutoDefine can look words up in.
+#
+# A source turns a word into a list of entries in the Merriam-Webster XML schema (see the top of autodefine.py), which
+# is what the rest of the add-on filters and renders; the Merriam-Webster dictionaries return those as they are, other
+# sources convert to it. Lookups go through the sources in priority order and stop at the first with a valid entry,
+# either one after another, or with every source asked at once (fan-out) so a slow or missing answer only costs the
+# time of the slowest source that actually has to be waited for. A source can set a timeout after which it's skipped
+# in favour of the next one, and every source keeps latency stats.
+
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from .instrumentation import in_current_context
+
+
+class Source:
+    # the interface every dictionary source implements
+    name = ""
+
+    # seconds to wait for this source before moving on to the next one, or None to wait for it to finish
+    timeout = None
+
+    def lookup(self, word):
+        # all entries the source has for the word, as <entry> elements; ones whose id doesn't match the word are
+        # shown as potential matches
+        raise NotImplementedError
+
+
+class SourceStats:
+    def __init__(self):
+        self.lookups = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, failed=False):
+        with self._lock:
+            self.lookups += 1
+            self.failures += failed
+            self.total_seconds += seconds
+            self.slowest_seconds = max(self.slowest_seconds, seconds)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def summary(self):
+        with self._lock:
+            average = self.total_seconds / self.lookups if self.lookups else 0
+            return "%d lookups, %.0f ms average, %.0f ms slowest, %d timeouts, %d failures" \
+                   % (self.lookups, average * 1000, self.slowest_seconds * 1000, self.timeouts, self.failures)
+
+
+class SourceRegistry:
+    def __init__(self):
+        self._sources = []
+        self.stats = {}
+
+    def register(self, source, priority=100):
+        # lower priorities are asked first; sources with the same priority in the order they were registered
+        self.unregister(source.name)
+        self._sources.append((priority, len(self._sources), source))
+        self._sources.sort(key=lambda item: item[:2])
+        self.stats.setdefault(source.name, SourceStats())
+
+    def unregister(self, name):
+        self._sources = [item for item in self._sources if item[2].name != name]
+
+    def get(self, name):
+        for _, _, source in self._sources:
+            if source.name == name:
+                return source
+        return None
+
+    def ordered(self, preferred=None):
+        sources = [source for _, _, source in self._sources]
+        if preferred:
+            sources.sort(key=lambda source: source.name != preferred)
+        return sources
+
+    def lookup(self, source, word):
+        start = time.perf_counter()
+        try:
+            entries = source.lookup(word)
+        except Exception:
+            self.stats[source.name].record(time.perf_counter() - start, failed=True)
+            raise
+        self.stats[source.name].record(time.perf_counter() - start)
+        return entries
+
+    def first_valid(self, word, select, executor, preferred=None, fan_out=False):
+        # Returns the valid entries of the first source (in priority order) that has any, along with the potential
+        # matches of the sources asked before it. select(word, entries) splits entries into valid and potential ones.
+        sources = self.ordered(preferred)
+        futures = {}
+        if fan_out:
+            # the first source is looked up on this thread below, unless it has to be able to time out
+            background = sources[1:] if sources and sources[0].timeout is None else sources
+            for source in background:
+                futures[source.name] = executor.submit(in_current_context(self.lookup), source, word)
+
+        potential = set()
+        for source in sources:
+            future = futures.get(source.name)
+            if future is None and source.timeout is None:
+                entries = self.lookup(source, word)
+            else:
+                if future is None:
+                    future = executor.submit(in_current_context(self.lookup), source, word)
+                try:
+                    entries = future.result(timeout=source.timeout)
+                except FutureTimeoutError:
+                    # it keeps running in the background, but we don't wait for it any longer
+                    self.stats[source.name].record_timeout()
+                    continue
+            selected = select(word, entries)
+            if selected.valid:
+                return selected.valid, potential
+            potential |= selected.potential
+        return [], potential
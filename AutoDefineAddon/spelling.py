@@ -0,0 +1,90 @@
+# "Did you mean" suggestions from the headwords AutoDefine already knows, without asking the dictionary.
+#
+# This is a symmetric delete index (as in SymSpell): every known word is stored under each string that can be made by
+# deleting up to max_distance characters from it, so the candidates for a misspelling are found by generating its own
+# deletes and looking them up, instead of comparing it against every known word. Only the first prefix_length
+# characters are used for the deletes, which keeps the index small for long words; candidates are then ranked by their
+# actual edit distance to the misspelling.
+
+import threading
+
+
+def edit_distance(a, b, max_distance):
+    # Damerau-Levenshtein distance (optimal string alignment), or max_distance + 1 once it's clear it will be larger
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+class SpellingIndex:
+    def __init__(self, max_distance=2, prefix_length=7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self._words = set()
+        # delete -> word, or a list of words once there's more than one
+        self._deletes = {}
+        self._lock = threading.Lock()
+
+    def _variants(self, word):
+        variants = {word}
+        frontier = {word}
+        for _ in range(self.max_distance):
+            frontier = {candidate[:i] + candidate[i + 1:] for candidate in frontier for i in range(len(candidate))}
+            variants |= frontier
+        return variants
+
+    def add(self, word):
+        word = word.lower()
+        with self._lock:
+            if not word or word in self._words:
+                return
+            self._words.add(word)
+            for variant in self._variants(word[:self.prefix_length]):
+                bucket = self._deletes.get(variant)
+                if bucket is None:
+                    self._deletes[variant] = word
+                elif isinstance(bucket, str):
+                    self._deletes[variant] = [bucket, word]
+                else:
+                    bucket.append(word)
+
+    def __contains__(self, word):
+        return word.lower() in self._words
+
+    def __len__(self):
+        return len(self._words)
+
+    def suggest(self, word, limit=5):
+        # known words within max_distance edits of word, closest first
+        word = word.lower()
+        candidates = set()
+        with self._lock:
+            for variant in self._variants(word[:self.prefix_length]):
+                bucket = self._deletes.get(variant)
+                if bucket is None:
+                    continue
+                if isinstance(bucket, str):
+                    candidates.add(bucket)
+                else:
+                    candidates.update(bucket)
+        candidates.discard(word)
+
+        ranked = []
+        for candidate in candidates:
+            distance = edit_distance(word, candidate, self.max_distance)
+            if distance <= self.max_distance:
+                ranked.append((distance, abs(len(candidate) - len(word)), candidate))
+        ranked.sort()
+        return [candidate for _, _, candidate in ranked[:limit]]
@@ -0,0 +1,92 @@
+# Streaming import of word lists into new notes.
+#
+# A list is read lazily, one word at a time, and fed through a chain of generators: lookups run on a thread pool with a
+# bounded number in flight and come back in list order, and are then grouped into batches that get turned into notes.
+# Memory use therefore doesn't depend on the length of the list. After every batch the number of words handled so far
+# is saved as a checkpoint, so an import that was stopped (e.g. by the daily API limit) carries on from there when the
+# same file is imported again.
+
+import collections
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+def read_words(path, skip=0):
+    # plain text lists have one word per line; for .csv and .tsv files the word is the first column
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        extension = os.path.splitext(path)[1].lower()
+        if extension in (".csv", ".tsv"):
+            rows = (row[0] if row else "" for row in csv.reader(f, delimiter="\t" if extension == ".tsv" else ","))
+        else:
+            rows = f
+        words = (row.strip() for row in rows)
+        yield from islice((word for word in words if word and not word.startswith("#")), skip, None)
+
+
+def count_words(path):
+    return sum(1 for _ in read_words(path))
+
+
+def ordered_map(func, items, workers, max_in_flight):
+    # like executor.map, but only pulls max_in_flight items ahead of the consumer instead of the whole iterable
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="AutoDefine-import") as executor:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= max_in_flight:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def batched(items, size):
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class ImportCheckpoint:
+    # One checkpoint per word list, recognised by its path, size and modification time, so editing the list starts
+    # the import over instead of skipping the wrong words.
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _key(list_path):
+        stat = os.stat(list_path)
+        return "%s|%d|%d" % (os.path.abspath(list_path), stat.st_size, int(stat.st_mtime))
+
+    def get(self, list_path):
+        return self._load().get(self._key(list_path))
+
+    def save(self, list_path, progress):
+        checkpoints = self._load()
+        checkpoints[self._key(list_path)] = progress
+        self._write(checkpoints)
+
+    def clear(self, list_path):
+        checkpoints = self._load()
+        if checkpoints.pop(self._key(list_path), None) is not None:
+            self._write(checkpoints)
+
+    def _write(self, checkpoints):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoints, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
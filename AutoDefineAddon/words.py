@@ -0,0 +1,7 @@
+# Normalization of the words everything is keyed by (lookup cache, offline pack, collection index). Kept in a module of
+# its own without any imports, so using it doesn't load e.g. sqlite3 while Anki starts up.
+
+
+def normalize_word(word):
+    # the API is case-insensitive, so "Set" and "set" share one cached response
+    return " ".join(word.split()).lower()
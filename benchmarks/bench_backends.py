@@ -0,0 +1,73 @@
+# Compares AutoDefine's XML and JSON API backends on recorded responses for the same words, without Anki or network
+# access: bytes downloaded (as sent, and gzip-compressed the way the connection pool requests them), time to decode a
+# response into entries, and whether both render exactly the same fields.
+#
+#   python benchmarks/bench_backends.py
+#
+# Every <DICTIONARY>/<word>.xml in the fixtures directory with a <word>.json next to it is compared. The bundled JSON
+# fixtures hold the same entries as the XML ones, in the v3 API's schema.
+
+import argparse
+import gzip
+import os
+import sys
+
+from bench_pipeline import ABBREVIATIONS, BENCHMARKS_DIR, load_addon_modules, measure
+
+
+def fixture_pairs(fixtures_dir):
+    for dictionary in sorted(os.listdir(fixtures_dir)):
+        dictionary_dir = os.path.join(fixtures_dir, dictionary)
+        if not os.path.isdir(dictionary_dir):
+            continue
+        for filename in sorted(os.listdir(dictionary_dir)):
+            json_path = os.path.join(dictionary_dir, filename[:-len(".xml")] + ".json")
+            if filename.endswith(".xml") and os.path.exists(json_path):
+                with open(os.path.join(dictionary_dir, filename), "rb") as f:
+                    xml_body = f.read()
+                with open(json_path, "rb") as f:
+                    json_body = f.read()
+                yield dictionary, filename[:-len(".xml")], xml_body, json_body
+
+
+def rendered_fields(parsing, render, word, entries):
+    valid = parsing.filter_entries_lower_and_potential(word, entries).valid
+    return (render.render_definitions(valid, True, ABBREVIATIONS), render.sound_urls(valid),
+            render.render_phonetic_transcriptions(valid, ABBREVIATIONS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare AutoDefine's XML and JSON API backends offline.")
+    parser.add_argument("--fixtures", default=os.path.join(BENCHMARKS_DIR, "fixtures"),
+                        help="directory of recorded responses laid out as <DICTIONARY>/<word>.xml and <word>.json")
+    parser.add_argument("--seconds", type=float, default=0.5, help="time to spend on each benchmark")
+    parser.add_argument("--min-runs", type=int, default=20, help="minimum runs per benchmark")
+    args = parser.parse_args()
+
+    offline_pack, parsing, render = load_addon_modules()
+    from AutoDefineAddon import json_api
+
+    header = "%-24s %9s %9s %9s %9s %11s %11s %6s" % ("word", "XML B", "JSON B", "XML gz", "JSON gz",
+                                                      "XML p50 us", "JSON p50 us", "same")
+    print(header)
+    print("-" * len(header))
+    mismatches = 0
+    for dictionary, word, xml_body, json_body in fixture_pairs(args.fixtures):
+        xml_time = measure(lambda: parsing.parse_entries(xml_body, word), args.seconds, args.min_runs)
+        json_time = measure(lambda: json_api.parse_json_entries(json_body, word, dictionary), args.seconds,
+                            args.min_runs)
+        same = rendered_fields(parsing, render, word, parsing.parse_entries(xml_body, word)) == \
+            rendered_fields(parsing, render, word, json_api.parse_json_entries(json_body, word, dictionary))
+        mismatches += not same
+        print("%-24s %9d %9d %9d %9d %11.1f %11.1f %6s"
+              % ("%s/%s" % (dictionary, word), len(xml_body), len(json_body), len(gzip.compress(xml_body)),
+                 len(gzip.compress(json_body)), xml_time["p50_us"], json_time["p50_us"], "yes" if same else "NO"))
+
+    if mismatches:
+        print("\n%d word(s) render differently from the two backends" % mismatches)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+# Benchmarks AutoDefine's parse and render pipeline on recorded dictionary responses, without Anki or network access.
+#
+#   python benchmarks/bench_pipeline.py                    run and print ops/sec, p50/p99 latency and peak memory
+#   python benchmarks/bench_pipeline.py --compare          also compare against benchmarks/baseline.json
+#   python benchmarks/bench_pipeline.py --save-baseline    record this run as the new baseline
+#
+# The baseline isn't checked in, since it has to come from the machine it's compared on: record one with
+# --save-baseline (e.g. on the commit before a change), then run --compare after it. Each benchmark is compared by its
+# time relative to a reference workload measured in the same run, so a machine that's busier or has changed clock
+# speed in the meantime doesn't show up as a regression.
+#
+# Responses are read from <fixtures>/<DICTIONARY>/<word>.xml, the same layout the add-on uses for recorded responses
+# in user_files/recorded, so real recordings can be benchmarked with --fixtures. The bundled fixtures follow the API's
+# XML schema; run.xml and set.xml are generated to mimic the size and shape of very common words.
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import types
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "AutoDefineAddon")
+
+# the add-on's default PART_OF_SPEECH_ABBREVIATION setting
+ABBREVIATIONS = {"verb": "v.", "noun": "n.", "adverb": "adv.", "adjective": "adj."}
+
+
+def load_addon_modules():
+    # The add-on package's __init__ imports Anki, so register the package without running it; the modules benchmarked
+    # here only import each other and the standard library.
+    package = types.ModuleType("AutoDefineAddon")
+    package.__path__ = [ADDON_DIR]
+    sys.modules["AutoDefineAddon"] = package
+    from AutoDefineAddon import offline_pack, parsing, render
+    return offline_pack, parsing, render
+
+
+def build_stages(parsing, render):
+    def parse(word, body):
+        return parsing.parse_entries(body, word)
+
+    def filter_entries(word, body, entries):
+        return parsing.filter_entries_lower_and_potential(word, entries)
+
+    def definitions(word, body, entries):
+        return render.render_definitions(parsing.filter_entries_lower_and_potential(word, entries).valid, True,
+                                         ABBREVIATIONS)
+
+    def sounds(word, body, entries):
+        return render.sound_urls(parsing.filter_entries_lower_and_potential(word, entries).valid)
+
+    def phonetics(word, body, entries):
+        return render.render_phonetic_transcriptions(parsing.filter_entries_lower_and_potential(word, entries).valid,
+                                                     ABBREVIATIONS)
+
+    def pipeline(word, body):
+        valid = parsing.filter_entries_lower_and_potential(word, parsing.parse_entries(body, word)).valid
+        render.sound_urls(valid)
+        render.render_phonetic_transcriptions(valid, ABBREVIATIONS)
+        return render.render_definitions(valid, True, ABBREVIATIONS)
+
+    # stages taking parsed entries reuse one parse per fixture, so they measure only their own work
+    return [("parse", parse, False),
+            ("filter", filter_entries, True),
+            ("render", definitions, True),
+            ("sounds", sounds, True),
+            ("phonetic", phonetics, True),
+            ("pipeline", pipeline, False)]
+
+
+# Parsing and walking a fixed XML document with the standard library, the same kind of work the pipeline does but
+# without any of the add-on's code. It's timed alongside every benchmark, and --compare looks at how long a benchmark
+# takes relative to it rather than in microseconds, so a baseline still holds on a faster or slower (or busier) machine.
+_REFERENCE_XML = ("<entry_list>%s</entry_list>"
+                  % "".join('<entry id="w[%d]"><hw>w</hw><fl>noun</fl><def><dt>:a definition <it>of</it> w</dt></def>'
+                            "</entry>" % i for i in range(20))).encode()
+
+
+def _reference():
+    from xml.etree import ElementTree as ET
+    return ["".join(dt.itertext()) for dt in ET.fromstring(_REFERENCE_XML).iter("dt")]
+
+
+def _timed(call):
+    start = time.perf_counter_ns()
+    call()
+    return time.perf_counter_ns() - start
+
+
+def measure(call, seconds, min_runs, rounds=5):
+    # Runs alternate with runs of the reference workload, so both see the same conditions, and are split into rounds
+    # each giving a ratio between the two; the lowest one is kept, since a round that was disturbed (by the garbage
+    # collector, or another process) only comes out slower.
+    timings = []
+    ratios = []
+    for _ in range(rounds):
+        round_timings = []
+        reference_timings = []
+        deadline = time.perf_counter() + seconds / rounds
+        while len(round_timings) < min_runs or time.perf_counter() < deadline:
+            round_timings.append(_timed(call))
+            reference_timings.append(_timed(_reference))
+        ratios.append(statistics.median(round_timings) / statistics.median(reference_timings))
+        timings += round_timings
+    timings.sort()
+
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"runs": len(timings),
+            "ops_per_sec": len(timings) / (sum(timings) / 1e9),
+            "p50_us": statistics.median(timings) / 1000,
+            "relative_p50": min(ratios),
+            "p99_us": timings[min(len(timings) - 1, int(len(timings) * 0.99))] / 1000,
+            "peak_kib": peak / 1024}
+
+
+def run(fixtures_dir, seconds, min_runs, only):
+    offline_pack, parsing, render = load_addon_modules()
+    stages = build_stages(parsing, render)
+    results = {}
+    for dictionary, word, body in offline_pack.read_recorded_responses(fixtures_dir):
+        entries = parsing.parse_entries(body, word)
+        for stage_name, stage, takes_entries in stages:
+            name = "%s/%s/%s" % (dictionary, word, stage_name)
+            if only and only not in name:
+                continue
+            if takes_entries:
+                results[name] = measure(lambda: stage(word, body, entries), seconds, min_runs)
+            else:
+                results[name] = measure(lambda: stage(word, body), seconds, min_runs)
+            results[name]["bytes"] = len(body)
+    return results
+
+
+def print_results(results, baseline):
+    header = "%-34s %8s %12s %10s %10s %10s" % ("benchmark", "KiB in", "ops/sec", "p50 us", "p99 us", "peak KiB")
+    if baseline:
+        header += " %9s" % "p50 vs"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        line = "%-34s %8.1f %12.0f %10.1f %10.1f %10.1f" % (name, result["bytes"] / 1024, result["ops_per_sec"],
+                                                            result["p50_us"], result["p99_us"], result["peak_kib"])
+        if baseline and name in baseline:
+            line += " %+8.1f%%" % _change(baseline[name], result)
+        print(line)
+
+
+def _change(before, after):
+    # p50 relative to the reference workload's, so baselines recorded on a faster or slower machine still compare
+    return (after["relative_p50"] - before["relative_p50"]) / before["relative_p50"] * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AutoDefine's parse and render pipeline offline.")
+    parser.add_argument("--fixtures", default=os.path.join(BENCHMARKS_DIR, "fixtures"),
+                        help="directory of recorded responses laid out as <DICTIONARY>/<word>.xml")
+    parser.add_argument("--baseline", default=os.path.join(BENCHMARKS_DIR, "baseline.json"),
+                        help="baseline file to compare against or save to")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare p50 latency (relative to the reference workload) against the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="save this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=25.0,
+                        help="percent a benchmark's relative p50 may grow over the baseline before --compare fails")
+    parser.add_argument("--seconds", type=float, default=0.5, help="time to spend on each benchmark")
+    parser.add_argument("--min-runs", type=int, default=20, help="minimum runs per benchmark")
+    parser.add_argument("--only", help="only run benchmarks whose name contains this text, e.g. set/render")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.compare and not os.path.exists(args.baseline):
+        print("No baseline at %s yet. Record one on this machine with --save-baseline first." % args.baseline)
+        return 2
+
+    results = run(args.fixtures, args.seconds, args.min_runs, args.only)
+
+    baseline = None
+    if args.compare:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"results": results}, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("\nSaved baseline to %s" % args.baseline)
+
+    if baseline:
+        regressions = [name for name, result in results.items()
+                       if name in baseline and _change(baseline[name], result) > args.tolerance]
+        if regressions:
+            print("\n%d benchmark(s) regressed by more than %.0f%%: %s"
+                  % (len(regressions), args.tolerance, ", ".join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())